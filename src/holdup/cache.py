@@ -0,0 +1,37 @@
+import hashlib
+from pathlib import Path
+from time import time
+
+
+class ReadinessCache:
+    """
+    Successful checks shared between holdup processes (``--cache-dir``): a check that passed is published as an empty
+    file named after the hash of its definition (passwords included, thus not readable from the name), other processes
+    skip the check while the file's modification time is less than ``ttl`` seconds old.
+
+    Anyone that can write in the directory can make checks pass so it must only be shared with trusted processes.
+    """
+
+    def __init__(self, path, ttl, *, insecure=False):
+        self.path = Path(path)
+        self.ttl = ttl
+        self.insecure = insecure
+        self.path.mkdir(parents=True, exist_ok=True)
+
+    def entry(self, check):
+        definition = check.display(verbose=False, verbose_passwords=True)
+        if self.insecure:
+            definition += "\0insecure"
+        return self.path / hashlib.sha256(definition.encode()).hexdigest()
+
+    def fresh(self, check):
+        try:
+            return time() - self.entry(check).stat().st_mtime < self.ttl
+        except OSError:
+            return False
+
+    def publish(self, check):
+        try:
+            self.entry(check).touch()
+        except OSError:
+            pass  # the cache is an optimization, never a reason to fail
@@ -1,43 +1,98 @@
+"""
+The checks. To keep holdup's startup fast (it's usually a container entrypoint) nothing expensive is imported here:
+asyncio is only imported by the async methods (thus only when the async engine is used) and the checks that need big
+modules (ssl, urllib, psycopg) live in their own modules, imported only when a service spec needs them.
+"""
+
 import argparse
 import ast
 import builtins
+import importlib
 import os
-import re
 import socket
-import ssl
 import sys
+from concurrent.futures import as_completed
 from contextlib import closing
 from operator import methodcaller
-from urllib.parse import urlparse
-from urllib.parse import urlunparse
-from urllib.request import HTTPBasicAuthHandler
-from urllib.request import HTTPDigestAuthHandler
-from urllib.request import HTTPPasswordMgrWithDefaultRealm
-from urllib.request import HTTPSHandler
-from urllib.request import Request
-from urllib.request import build_opener
 
-from . import __version__
-from .pg import psycopg
+from . import net
+from .executor import DaemonExecutor
+
+CO_COROUTINE = 0x80  # inspect.CO_COROUTINE, without importing inspect
+
+LAZY_CHECKS = {
+    "HttpCheck": "holdup.http",
+    "PgCheck": "holdup.pg",
+    "PgWireCheck": "holdup.pgwire",
+    "RedisCheck": "holdup.wire",
+    "MemcachedCheck": "holdup.wire",
+    "AmqpCheck": "holdup.wire",
+    "MysqlCheck": "holdup.wire",
+    "TcpExpectCheck": "holdup.wire",
+    "GrpcCheck": "holdup.grpc",
+}
+
+
+def __getattr__(name):
+    if name in LAZY_CHECKS:
+        return getattr(importlib.import_module(LAZY_CHECKS[name]), name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 class Check:
     error = None
 
+    # per-service overrides for the --interval, --backoff, --max-interval and --jitter options
+    interval = None
+    backoff = None
+    max_interval = None
+    jitter = None
+
     def is_passing(self, options):
         try:
             self.run(options)
         except Exception as exc:
             self.error = exc
         else:
-            self.error = False
-            if options.verbose:
-                print(f"holdup: Passed check: {self.display(verbose=True, verbose_passwords=options.verbose_passwords)}")
-            return True
+            return self.passed(options)
+
+    async def ais_passing(self, options):
+        import asyncio
+
+        try:
+            await self.arun(options)
+        except asyncio.TimeoutError:
+            # same message as the blocking socket timeouts
+            self.error = socket.timeout("timed out")
+        except Exception as exc:
+            self.error = exc
+        else:
+            return self.passed(options)
+
+    def passed(self, options):
+        self.error = False
+        if options.verbose:
+            print(f"holdup: Passed check: {self.display(verbose=True, verbose_passwords=options.verbose_passwords)}")
+        return True
 
     def run(self, options):
         raise NotImplementedError
 
+    def watch_path(self):
+        """
+        Returns:
+            str: A path that has to change before the failed check can pass (so the check can be retried as soon as it
+                changes), or ``None``.
+        """
+
+    async def arun(self, options):
+        """
+        Asynchronous variant of :meth:`run`. Checks that don't implement this get their :meth:`run` called in a thread.
+        """
+        import asyncio
+
+        await asyncio.get_running_loop().run_in_executor(None, self.run, options)
+
     @property
     def status(self):
         if self.error:
@@ -67,106 +122,34 @@ class TcpCheck(Check):
         self.port = port
 
     def run(self, options):
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.settimeout(options.check_timeout)
-        with closing(sock):
-            sock.connect((self.host, self.port))
+        addresses = options.resolver.getaddrinfo(self.host, self.port, 0, socket.SOCK_STREAM)
+        with closing(net.connect(addresses, options.check_timeout)):
+            pass
+
+    async def arun(self, options):
+        import asyncio
+
+        await asyncio.wait_for(self.aconnect(options), options.check_timeout)
+
+    async def aconnect(self, options):
+        addresses = await options.resolver.agetaddrinfo(self.host, self.port, 0, socket.SOCK_STREAM)
+        with closing(await net.aconnect(addresses)):
+            pass
 
     def __repr__(self):
         return f"TcpCheck(host={self.host!r}, port={self.port!r})"
 
     def display(self, *, verbose, **_):
-        definition = f"tcp://{self.host}:{self.port}"
+        if ":" in self.host:
+            definition = f"tcp://[{self.host}]:{self.port}"
+        else:
+            definition = f"tcp://{self.host}:{self.port}"
         if verbose:
             return f"{definition!r} -> {self.status}"
         else:
             return definition
 
 
-class PgCheck(Check):
-    def __init__(self, connection_string):
-        self.connection_string = connection_string
-        if "?" in connection_string.rsplit("/", 1)[1]:
-            self.separator = "&"
-        else:
-            self.separator = "?"
-
-    def run(self, options):
-        with closing(
-            psycopg.connect(f"{self.connection_string}{self.separator}connect_timeout={max(1, int(options.check_timeout))}")
-        ) as conn:
-            with closing(conn.cursor()) as cur:
-                cur.execute("SELECT version()")
-                cur.fetchone()
-
-    def __repr__(self):
-        return f"PgCheck({self.connection_string})"
-
-    def display_definition(self, *, verbose_passwords, _password_re=re.compile(r":[^@:]+@")):
-        definition = str(self.connection_string)
-        if not verbose_passwords:
-            definition = _password_re.sub(":******@", definition, 1)
-        return definition
-
-
-class HttpCheck(Check):
-    def __init__(self, url):
-        self.handlers = []
-        self.parsed_url = url = urlparse(url)
-        self.scheme = url.scheme
-        self.insecure = False
-        if url.scheme == "https+insecure":
-            self.insecure = True
-            url = url._replace(scheme="https")
-
-        if url.port:
-            self.netloc = f"{url.hostname}:{url.port}"
-        else:
-            self.netloc = url.hostname
-        self.host = url.hostname
-
-        cleaned_url = urlunparse(url._replace(netloc=self.netloc))
-
-        if url.username or url.password:
-            password_mgr = HTTPPasswordMgrWithDefaultRealm()
-            password_mgr.add_password(None, cleaned_url, url.username, url.password)
-            self.handlers.append(HTTPDigestAuthHandler(passwd=password_mgr))
-            self.handlers.append(HTTPBasicAuthHandler(password_mgr=password_mgr))
-
-        self.url = cleaned_url
-
-    def run(self, options):
-        handlers = list(self.handlers)
-        insecure = self.insecure or options.insecure
-
-        ssl_ctx = ssl.create_default_context()
-        if insecure:
-            ssl_ctx.check_hostname = False
-            ssl_ctx.verify_mode = ssl.CERT_NONE
-        handlers.append(HTTPSHandler(context=ssl_ctx))
-
-        opener = build_opener(*handlers)
-        opener.addheaders = [("User-Agent", f"python-holdup/{__version__}")]
-        request = Request(self.url, headers={"Host": self.host})  # noqa: S310
-        with closing(opener.open(request, timeout=options.check_timeout)) as req:
-            status = req.getcode()
-            if status != 200:
-                raise Exception(f"Expected status code 200, got {status!r}")
-
-    def __repr__(self):
-        return f"HttpCheck({self.url}, insecure={self.insecure}, status={self.status})"
-
-    def display_definition(self, *, verbose_passwords):
-        url = self.parsed_url
-        if url.username and not verbose_passwords:
-            if not url.password:
-                mask = "******"
-            else:
-                mask = f"{url.username}:******"
-            url = url._replace(netloc=f"{mask}@{self.netloc}")
-        return urlunparse(url)
-
-
 class UnixCheck(Check):
     def __init__(self, path):
         self.path = path
@@ -177,6 +160,17 @@ class UnixCheck(Check):
         with closing(sock):
             sock.connect(self.path)
 
+    async def arun(self, options):
+        import asyncio
+
+        _, writer = await asyncio.wait_for(asyncio.open_unix_connection(self.path), options.check_timeout)
+        writer.close()
+
+    def watch_path(self):
+        # once the socket exists it's only a matter of the server listening
+        if isinstance(self.error, (FileNotFoundError, PermissionError)):
+            return self.path
+
     def __repr__(self):
         return f"UnixCheck({self.path!r}, status={self.status})"
 
@@ -194,6 +188,9 @@ class PathCheck(Check):
         if not os.access(self.path, os.R_OK):
             raise Exception(f"Failed access({self.path!r}, R_OK) test")
 
+    def watch_path(self):
+        return self.path
+
     def __repr__(self):
         return f"PathCheck({self.path!r}, status={self.status})"
 
@@ -202,26 +199,83 @@ class PathCheck(Check):
 
 
 class EvalCheck(Check):
+    """
+    The expression is compiled once. It may ``await`` (then it's evaluated in the event loop with the async engine, in a
+    new event loop with the thread engine) and it may evaluate to an awaitable or to a coroutine function (called without
+    arguments), their result is checked instead.
+
+    The modules it uses are imported by :meth:`import_names`, unless it's evaluated by a ``worker`` (a
+    :class:`holdup.evalworker.EvalWorker`).
+    """
+
+    worker = None
+
     def __init__(self, expr):
         self.expr = expr
         self.ns = {}
         try:
-            tree = ast.parse(expr)
+            tree = ast.parse(expr, mode="eval")
+            self.code = compile(tree, "<holdup eval>", "eval", flags=ast.PyCF_ALLOW_TOP_LEVEL_AWAIT)
         except SyntaxError as exc:
+            if exc.text is None or exc.offset is None:  # some errors from compile() don't point anywhere
+                raise argparse.ArgumentTypeError(f"Invalid service spec {expr!r}. Parse error: {exc}") from None
             raise argparse.ArgumentTypeError(
-                f'Invalid service spec {expr!r}. Parse error:\n  {exc.text} {" " * exc.offset}^\n{exc}'
+                f'Invalid service spec {expr!r}. Parse error:\n  {exc.text.rstrip()}\n {" " * exc.offset}^\n{exc}'
             ) from None
-        for node in ast.walk(tree):
-            if isinstance(node, ast.Name):
-                if not hasattr(builtins, node.id):
-                    try:
-                        __import__(node.id)
-                    except ImportError as exc:
-                        raise argparse.ArgumentTypeError(f"Invalid service spec {expr!r}. Import error: {exc}") from None
-                    self.ns[node.id] = sys.modules[node.id]
+        names = (node.id for node in ast.walk(tree) if isinstance(node, ast.Name))
+        self.names = list(dict.fromkeys(name for name in names if not hasattr(builtins, name)))
+
+    def import_names(self):
+        """
+        Raises:
+            argparse.ArgumentTypeError: If a name used in the expression isn't an importable module.
+        """
+        for name in self.names:
+            try:
+                __import__(name)
+            except ImportError as exc:
+                raise argparse.ArgumentTypeError(f"Invalid service spec {self.expr!r}. Import error: {exc}") from None
+            self.ns[name] = sys.modules[name]
+
+    def evaluate(self):
+        # a copy, so assignment expressions don't leak between attempts
+        result = eval(self.code, dict(self.ns))  # noqa: S307
+        if callable(result):
+            import inspect
+
+            if inspect.iscoroutinefunction(result):
+                result = result()
+        return result
 
-    def run(self, _):
-        result = eval(self.expr, dict(self.ns), dict(self.ns))  # noqa: S307
+    def run(self, options):
+        if self.worker:
+            self.worker.evaluate(options.check_timeout)
+            return
+        result = self.evaluate()
+        if hasattr(result, "__await__"):
+            import asyncio
+
+            async def resolve():
+                return await result
+
+            result = asyncio.run(resolve())
+        self.check_result(result)
+
+    async def arun(self, options):
+        import asyncio
+
+        if self.worker:
+            await super().arun(options)
+            return
+        elif self.code.co_flags & CO_COROUTINE:
+            result = self.evaluate()  # only makes the coroutine
+        else:
+            result = await asyncio.get_running_loop().run_in_executor(None, self.evaluate)
+        if hasattr(result, "__await__"):
+            result = await result
+        self.check_result(result)
+
+    def check_result(self, result):
         if not result:
             raise Exception(f"Failed to evaluate {self.expr!r}. Result {result!r} is falsey")
 
@@ -237,12 +291,45 @@ class AnyCheck(Check):
         self.checks = checks
 
     def run(self, options):
-        for check in self.checks:
-            if check.is_passing(options):
+        # all the alternatives are raced, the ones still running after the first pass are abandoned
+        executor = DaemonExecutor()
+        futures = {executor.submit(check.run, options): check for check in self.checks}
+        executor.shutdown(wait=False)
+        for future in as_completed(futures):
+            check = futures[future]
+            error = future.exception()
+            if error:
+                check.error = error
+            else:
+                check.passed(options)
                 break
         else:
             raise Exception("ALL FAILED")
 
+    async def arun(self, options):
+        import asyncio
+
+        tasks = {asyncio.ensure_future(check.arun(options)): check for check in self.checks}
+        pending = set(tasks)
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    check = tasks[task]
+                    error = task.exception()
+                    if isinstance(error, asyncio.TimeoutError):
+                        # same message as the blocking socket timeouts
+                        check.error = socket.timeout("timed out")
+                    elif error:
+                        check.error = error
+                    else:
+                        check.passed(options)
+                        return
+            raise Exception("ALL FAILED")
+        finally:
+            for task in pending:
+                task.cancel()
+
     def __repr__(self):
         return f'AnyCheck({", ".join(map(repr, self.checks))}, status={self.status})'
 
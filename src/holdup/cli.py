@@ -17,39 +17,151 @@ Why does this file exist, and why not put this in __main__?
 
 import argparse
 import os
+import re
+import signal
+import socket
 import sys
 from operator import methodcaller
 from shlex import quote
-from time import sleep
-from time import time
+from urllib.parse import unquote
 
 from . import __version__
+from .cache import ReadinessCache
 from .checks import AnyCheck
 from .checks import EvalCheck
-from .checks import HttpCheck
 from .checks import PathCheck
-from .checks import PgCheck
 from .checks import TcpCheck
 from .checks import UnixCheck
-from .pg import make_conninfo
-from .pg import psycopg
+from .dns import Resolver
+from .engine import ENGINES
+from .net import ConnectionPool
+from .report import report_destination
+
+# the default --concurrency is one for each service, up to this
+MAX_DEFAULT_CONCURRENCY = 32
+
+# the hidden command that runs an --eval-worker in frozen builds (where there's no "python -m holdup.evalworker")
+EVAL_WORKER_COMMAND = "_eval-worker"
 
 
 def parse_service(service):
     if "://" not in service:
         raise argparse.ArgumentTypeError(f'Invalid service spec {service!r}. Must have "://".')
+    if "eval://" in service:
+        settings = {}
+    else:
+        service, settings = split_settings(service, SCHEDULING_SETTINGS)
     proto, value = service.split("://", 1)
 
+    parts = [value]
     if "," in value and proto != "eval":
-        parts = value.split(",")
-        for pos, part in enumerate(parts):
+        parts = []
+        for pos, part in enumerate(value.split(",")):
             if part.startswith("eval://"):
-                parts[pos] = ",".join(parts[pos:])
-                del parts[pos + 1 :]
+                parts.append(",".join(value.split(",")[pos:]))
                 break
-        return AnyCheck([parse_value(part, proto) for part in parts])
+            elif parts and continues_status_list(proto, parts[-1], part):
+                parts[-1] += f",{part}"
+            else:
+                parts.append(part)
+    if len(parts) > 1:
+        check = AnyCheck([parse_value(part, proto) for part in parts])
     else:
-        return parse_value(value, proto)
+        check = parse_value(parts[0], proto)
+    for name, value in settings.items():
+        try:
+            value = SCHEDULING_SETTINGS[name](value)
+        except ValueError as exc:
+            raise argparse.ArgumentTypeError(f"Invalid service spec {service!r}. Bad {name} option: {exc}") from None
+        setattr(check, name.replace("-", "_"), value)
+    return check
+
+
+def continues_status_list(proto, previous, part):
+    """
+    Returns:
+        bool: ``True`` if ``part`` (of a comma-separated service spec) is more status codes for the preceding http*
+        service, eg: the ``401`` in ``"http://host/?status=200-299,401"``.
+    """
+    if "://" in previous:
+        proto, previous = previous.split("://", 1)
+    if not proto.startswith("http") or "?" not in previous:
+        return False
+    last_parameter = re.split("[?&]", previous)[-1]
+    return last_parameter.startswith("status=") and part.split("&", 1)[0].replace("-", "").isdigit()
+
+
+def split_settings(service, names):
+    """
+    Removes the holdup-specific query-style settings (eg: ``?interval=1&backoff=exponential``) from the end of a service spec.
+    Anything else in the query string is left in place.
+
+    Returns:
+        tuple: The cleaned up service spec and a dict with the settings.
+    """
+    head, sep, query = service.rpartition("?")
+    if not sep:
+        return service, {}
+    settings = {}
+    rest = []
+    for part in query.split("&"):
+        name, _, value = part.partition("=")
+        if name in names:
+            settings[name] = unquote(value)
+        else:
+            rest.append(part)
+    if rest:
+        head = f"{head}?{'&'.join(rest)}"
+    return head, settings
+
+
+def positive_float(value):
+    value = float(value)
+    if value < 0:
+        raise ValueError(f"{value} is negative")
+    return value
+
+
+def port_number(value):
+    if not value.isdigit() or not 0 <= int(value) <= 65535:
+        raise argparse.ArgumentTypeError(f"Invalid port {value!r}. Must be a number between 0 and 65535.")
+    return int(value)
+
+
+def fraction(value):
+    value = float(value)
+    if not 0 <= value <= 1:
+        raise ValueError(f"{value} is not between 0 and 1")
+    return value
+
+
+def backoff(value):
+    if value not in BACKOFFS:
+        raise ValueError(f'{value!r} is not one of {", ".join(map(repr, BACKOFFS))}')
+    return value
+
+
+def listen_address(value):
+    """
+    Returns:
+        tuple: The address family and the address (a path for unix sockets).
+    """
+    if value.startswith("unix://"):
+        return socket.AF_UNIX, value[len("unix://") :]
+    host, sep, port = value.rpartition(":")
+    if not sep or not port.isdigit() or int(port) > 65535:
+        raise argparse.ArgumentTypeError(f'Invalid address {value!r}. Must be "[HOST]:PORT" or "unix:///path/to/socket".')
+    host = host.strip("[]")
+    return socket.AF_INET6 if ":" in host else socket.AF_INET, (host, int(port))
+
+
+BACKOFFS = ("constant", "exponential")
+SCHEDULING_SETTINGS = {
+    "interval": positive_float,
+    "backoff": backoff,
+    "max-interval": positive_float,
+    "jitter": fraction,
+}
 
 
 def parse_value(value, proto):
@@ -60,12 +172,17 @@ def parse_value(value, proto):
     if proto == "tcp":
         if ":" not in value:
             raise argparse.ArgumentTypeError(f'Invalid service spec {display_value!r}. Must have ":". Where\'s the port?')
-        host, port = value.strip("/").split(":", 1)
+        host, port = value.strip("/").rsplit(":", 1)
+        host = host.strip("[]")
         if not port.isdigit():
             raise argparse.ArgumentTypeError(f"Invalid service spec {display_value!r}. Port must be a number not {port!r}.")
         port = int(port)
         return TcpCheck(host, port)
     elif proto in ("pg", "postgresql", "postgres"):
+        from .pg import PgCheck
+        from .pg import make_conninfo
+        from .pg import psycopg
+
         if psycopg is None:
             raise argparse.ArgumentTypeError(f"Protocol {proto} unusable. Install holdup[pg].")
 
@@ -75,48 +192,225 @@ def parse_value(value, proto):
         except Exception as exc:
             raise argparse.ArgumentTypeError(f"Failed to parse {display_value!r}: {exc}. Must be a valid connection URI.") from None
         return PgCheck(connection_uri)
+    elif proto == "pgwire":
+        from .pgwire import PgWireCheck
+
+        return PgWireCheck(f"pgwire://{value}")
+    elif proto in ("redis", "memcached", "amqp", "mysql", "tcp+expect"):
+        from .wire import CHECKS
+
+        return CHECKS[proto](f"{proto}://{value}")
     elif proto == "unix":
         return UnixCheck(value)
     elif proto == "path":
         return PathCheck(value)
     elif proto in ("http", "https", "https+insecure"):
-        return HttpCheck(f"{proto}://{value}")
+        from .http import HTTP_SETTINGS
+        from .http import HttpCheck
+
+        value, settings = split_settings(value, HTTP_SETTINGS)
+        for name, setting in settings.items():
+            try:
+                settings[name] = HTTP_SETTINGS[name](setting)
+            except ValueError as exc:
+                raise argparse.ArgumentTypeError(f"Invalid service spec {display_value!r}. Bad {name} option: {exc}") from None
+        return HttpCheck(f"{proto}://{value}", **{name.replace("-", "_"): setting for name, setting in settings.items()})
+    elif proto in ("grpc", "grpcs", "grpcs+insecure"):
+        from .grpc import GrpcCheck
+
+        return GrpcCheck(f"{proto}://{value}")
     elif proto == "eval":
         return EvalCheck(value)
     else:
-        raise argparse.ArgumentTypeError(f'Unknown protocol {proto!r} in {display_value!r}. Must be "tcp", "path", "unix" or "pg".')
+        raise argparse.ArgumentTypeError(
+            f'Unknown protocol {proto!r} in {display_value!r}. Must be "tcp", "path", "unix", "pg", "pgwire", "redis", '
+            '"memcached", "amqp", "mysql", "tcp+expect", "grpc" or "grpcs".'
+        )
+
+
+def add_service_argument(parser):
+    parser.add_argument(
+        "service",
+        nargs=argparse.ONE_OR_MORE,
+        type=parse_service,
+        help="A service to wait for. "
+        "Supported protocols: "
+        '"tcp://host:port/", '
+        '"path:///path/to/something", '
+        '"unix:///path/to/domain.sock", '
+        '"eval://expr" (may await or evaluate to an awaitable), '
+        '"pg://user:password@host:port/dbname" ("postgres" and "postgresql" also allowed), '
+        '"pgwire://[user[:password]@]host[:port][/dbname][?sslmode=prefer]" (no psycopg needed, '
+        "like pg_isready without a password, logs in and runs SELECT 1 with one), "
+        '"redis://[[user]:password@]host[:port]" (PING, only PONG passes), '
+        '"memcached://host[:port]" (version), '
+        '"amqp://host[:port]" (protocol header, Connection.Start expected), '
+        '"mysql://host[:port]" (the server greeting, error packets fail), '
+        '"tcp+expect://host:port?send=PAYLOAD&expect=PAYLOAD" (percent-encoded, send is optional), '
+        '"http://urn", '
+        '"https://urn", '
+        '"https+insecure://urn" (status 200 expected for http*, see below for options), '
+        '"grpc://host[:port][/service]" (the standard health check, only SERVING passes; '
+        '"grpcs" and "grpcs+insecure" for TLS). '
+        "Join protocols with a comma to make holdup exit at the first "
+        'passing one, eg: "tcp://host:1,host:2" or "tcp://host:1,tcp://host:2" are equivalent and mean '
+        "`any that pass`. "
+        "The --interval, --backoff, --max-interval and --jitter options can be overridden for a service with query-style settings, "
+        'eg: "tcp://host:1?interval=1&backoff=exponential". '
+        "The http* protocols also take method (GET or HEAD), status (accepted status codes, eg: 200-299,401), "
+        "match (a regular expression the body must match, percent-encoded) and max-bytes (how much of the body match "
+        'reads, default: 65536), eg: "http://host/health?method=HEAD&status=200-399".',
+    )
+
+
+def add_check_arguments(parser):
+    parser.add_argument(
+        "-T",
+        "--check-timeout",
+        metavar="SECONDS",
+        type=float,
+        default=1.0,
+        help="Time to wait for a single check (stuck checks are abandoned). Default: %(default)s",
+    )
+    parser.add_argument("-i", "--interval", metavar="SECONDS", type=float, default=0.2, help="How often to check. Default: %(default)s")
+    parser.add_argument(
+        "--backoff",
+        choices=BACKOFFS,
+        default="constant",
+        help="How the interval changes after each failed check: constant or doubled each time (up to --max-interval). "
+        "Default: %(default)s",
+    )
+    parser.add_argument(
+        "--max-interval",
+        metavar="SECONDS",
+        type=float,
+        default=5.0,
+        help="Longest interval between checks with exponential backoff. Default: %(default)s",
+    )
+    parser.add_argument(
+        "--jitter",
+        metavar="FRACTION",
+        type=float,
+        default=0.0,
+        help="Randomize the interval by up to this fraction of it (eg: 0.2 means +/-20%%). Default: %(default)s",
+    )
+    parser.add_argument(
+        "-c",
+        "--concurrency",
+        metavar="N",
+        type=int,
+        default=None,
+        help=f"How many checks to run at the same time. Default: one for each service, up to {MAX_DEFAULT_CONCURRENCY}.",
+    )
+    parser.add_argument(
+        "-e",
+        "--engine",
+        choices=sorted(ENGINES),
+        default="thread",
+        help="How to run checks: in a pool of threads or as coroutines in a single thread. Default: %(default)s",
+    )
+    parser.add_argument(
+        "--dns-ttl",
+        metavar="SECONDS",
+        type=float,
+        default=30.0,
+        help="How long to cache DNS lookups (stale entries are refreshed in the background). Use 0 to disable the cache. "
+        "Default: %(default)s",
+    )
+    parser.add_argument(
+        "--no-watch",
+        action="store_true",
+        help="Don't use inotify to retry path:// and unix:// checks as soon as their path changes, only poll them every --interval.",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        metavar="PATH",
+        help="Share successful checks with other holdup processes through this directory: while fresh, "
+        "identical checks are skipped. Only share it with trusted processes. Default: disabled.",
+    )
+    parser.add_argument(
+        "--cache-ttl",
+        metavar="SECONDS",
+        type=float,
+        default=2.0,
+        help="How long a successful check stays fresh in the --cache-dir. Default: %(default)s",
+    )
+    parser.add_argument(
+        "--eval-worker",
+        action="store_true",
+        help="Evaluate eval:// services in a subprocess (one for each): the modules they use are imported there once, "
+        "without delaying the other checks, and an evaluation taking longer than --check-timeout is stopped by killing it.",
+    )
+    parser.add_argument(
+        "--reuse-pg-connections",
+        action="store_true",
+        help="Keep the connection of a successful pg:// check and only run SELECT 1 on it the next time (useful with serve), "
+        "instead of connecting and authenticating for every check.",
+    )
+
+
+def check_options(parser, options):
+    """
+    Validates the options added by :func:`add_check_arguments` and adds the objects shared by all the checks.
+    """
+    if options.concurrency is None:
+        options.concurrency = min(MAX_DEFAULT_CONCURRENCY, len(options.service))
+    elif options.concurrency < 1:
+        parser.error("--concurrency value must be a positive number!")
+    if options.max_interval < 0:
+        parser.error("--max-interval value must be a positive number!")
+    if not 0 <= options.jitter <= 1:
+        parser.error("--jitter value must be between 0 and 1!")
+    options.resolver = Resolver(options.dns_ttl)
+    options.http_pool = ConnectionPool()
+    options.pg_pool = ConnectionPool(max_idle=1) if options.reuse_pg_connections else None
+    options.eval_workers = []
+    for check in options.service:
+        for alternative in check.checks if isinstance(check, AnyCheck) else [check]:
+            if not isinstance(alternative, EvalCheck):
+                continue
+            elif options.eval_worker:
+                from .evalworker import EvalWorker
+
+                alternative.worker = EvalWorker(alternative.expr)
+                options.eval_workers.append(alternative.worker)
+            else:
+                try:
+                    alternative.import_names()
+                except argparse.ArgumentTypeError as exc:
+                    parser.error(f"argument service: {exc}")
+    if options.cache_dir:
+        try:
+            options.cache = ReadinessCache(options.cache_dir, options.cache_ttl, insecure=options.insecure)
+        except OSError as exc:
+            parser.error(f"--cache-dir unusable: {exc}")
+    else:
+        options.cache = None
 
 
 parser = argparse.ArgumentParser(
     usage="%(prog)s [-h] [-t SECONDS] [-T SECONDS] [-i SECONDS] [-n] service [service ...] " "[-- command [arg [arg ...]]]",
-    description="Wait for services to be ready and optionally exec command.",
-)
-parser.add_argument(
-    "service",
-    nargs=argparse.ONE_OR_MORE,
-    type=parse_service,
-    help="A service to wait for. "
-    "Supported protocols: "
-    '"tcp://host:port/", '
-    '"path:///path/to/something", '
-    '"unix:///path/to/domain.sock", '
-    '"eval://expr", '
-    '"pg://user:password@host:port/dbname" ("postgres" and "postgresql" also allowed), '
-    '"http://urn", '
-    '"https://urn", '
-    '"https+insecure://urn" (status 200 expected for http*). '
-    "Join protocols with a comma to make holdup exit at the first "
-    'passing one, eg: "tcp://host:1,host:2" or "tcp://host:1,tcp://host:2" are equivalent and mean '
-    "`any that pass`.",
+    description="Wait for services to be ready and optionally exec command. "
+    'Use "%(prog)s serve" to keep checking the services and serve their readiness over HTTP instead.',
 )
+add_service_argument(parser)
 parser.add_argument("command", nargs=argparse.OPTIONAL, help="An optional command to exec.")
 parser.add_argument(
     "-t", "--timeout", metavar="SECONDS", type=float, default=60.0, help="Time to wait for services to be ready. Default: %(default)s"
 )
+add_check_arguments(parser)
+parser.add_argument(
+    "--report",
+    metavar="json[:PATH]",
+    type=report_destination,
+    help="Write a report with the timings of all the attempts (written at exit, even if aborting). Default destination: stdout.",
+)
 parser.add_argument(
-    "-T", "--check-timeout", metavar="SECONDS", type=float, default=1.0, help="Time to wait for a single check. Default: %(default)s"
+    "--metrics-port",
+    metavar="PORT",
+    type=port_number,
+    help="Serve Prometheus metrics about the checks on http://0.0.0.0:PORT/metrics while waiting. Default: disabled.",
 )
-parser.add_argument("-i", "--interval", metavar="SECONDS", type=float, default=0.2, help="How often to check. Default: %(default)s")
 parser.add_argument("-v", "--verbose", action="store_true", help="Verbose mode.")
 parser.add_argument("--verbose-passwords", action="store_true", help="Disable PostgreSQL/HTTP password masking.")
 parser.add_argument(
@@ -127,6 +421,26 @@ parser.add_argument(
 )
 parser.add_argument("--insecure", action="store_true", help="Disable SSL Certificate verification for HTTPS services.")
 
+serve_parser = argparse.ArgumentParser(
+    prog="holdup serve",
+    description="Keep checking services (each one every --interval) and serve their aggregate readiness over HTTP: "
+    '"/ready" (status 200 if all the services passed their last check, 503 otherwise) and "/live". '
+    "Requests are answered from the last results, they never trigger checks.",
+)
+add_service_argument(serve_parser)
+add_check_arguments(serve_parser)
+serve_parser.add_argument(
+    "-l",
+    "--listen",
+    metavar="ADDRESS",
+    type=listen_address,
+    default=listen_address(":8000"),
+    help='Where to serve: "[HOST]:PORT" or "unix:///path/to/socket". Default: :8000',
+)
+serve_parser.add_argument("-v", "--verbose", action="store_true", help="Verbose mode.")
+serve_parser.add_argument("--verbose-passwords", action="store_true", help="Disable PostgreSQL/HTTP password masking.")
+serve_parser.add_argument("--insecure", action="store_true", help="Disable SSL Certificate verification for HTTPS services.")
+
 
 def add_version_argument(parser):
     parser.add_argument(
@@ -147,6 +461,12 @@ def main():
 
     Does stuff.
     """
+    if sys.argv[1:2] == ["serve"]:
+        return serve(sys.argv[2:])
+    elif sys.argv[1:2] == [EVAL_WORKER_COMMAND]:
+        from .evalworker import main as eval_worker
+
+        return eval_worker(sys.argv[2])
     add_version_argument(parser)
     if "--" in sys.argv:
         pos = sys.argv.index("--")
@@ -159,6 +479,7 @@ def main():
             options.check_timeout = options.timeout
         else:
             parser.error("--timeout value must be greater than --check-timeout value!")
+    check_options(parser, options)
     pending = list(options.service)
     brief_representer = methodcaller("display", verbose=False, verbose_passwords=options.verbose_passwords)
     verbose_representer = methodcaller("display", verbose=True, verbose_passwords=options.verbose_passwords)
@@ -167,13 +488,32 @@ def main():
             f"holdup: Waiting for {options.timeout}s ({options.check_timeout}s per check, {options.interval}s sleep between loops) "
             f'for these services: {", ".join(map(brief_representer, pending))}'
         )
-    start = time()
-    at_least_once = True
-    while at_least_once or pending and time() - start < options.timeout:
-        lapse = time()
-        pending = [check for check in pending if not check.is_passing(options)]
-        sleep(max(0, options.interval - time() + lapse))
-        at_least_once = False
+    report = None
+    if options.report:
+        from .report import open_destination
+
+        try:
+            report = open_destination(options.report)
+        except OSError as exc:
+            parser.error(f"--report destination unusable: {exc}")
+    engine = ENGINES[options.engine](options)
+    metrics = None
+    if options.metrics_port is not None:
+        from .metrics import MetricsServer
+
+        try:
+            metrics = MetricsServer(options.metrics_port, engine.report, options.service)
+        except OSError as exc:
+            parser.error(f"--metrics-port {options.metrics_port} unusable: {exc}")
+    try:
+        pending = engine.wait(pending)
+    finally:
+        if metrics:
+            metrics.stop()
+        if report:
+            engine.report.write(report, options.service, verbose_passwords=options.verbose_passwords)
+            if report is not sys.stdout:
+                report.close()
 
     if pending:
         if options.no_abort:
@@ -187,3 +527,32 @@ def main():
         if options.verbose:
             print(f'holdup: Executing: {" ".join(map(quote, command))}')
         os.execvp(command[0], command)  # noqa:S606
+
+
+def serve(argv):
+    """
+    The ``holdup serve`` command: keeps checking the services and serves their readiness until interrupted.
+
+    Returns:
+        int: A return code
+    """
+    from .serve import ReadinessServer
+
+    add_version_argument(serve_parser)
+    options = serve_parser.parse_args(args=argv)
+    check_options(serve_parser, options)
+    engine = ENGINES[options.engine](options)
+    brief_representer = methodcaller("display", verbose=False, verbose_passwords=options.verbose_passwords)
+    try:
+        server = ReadinessServer(options.listen, options.service, verbose_passwords=options.verbose_passwords)
+    except OSError as exc:
+        serve_parser.error(f"--listen address unusable: {exc}")
+    engine.report = server.readiness
+    for signum in signal.SIGINT, signal.SIGTERM:
+        signal.signal(signum, lambda *_: engine.stop())
+    if options.verbose:
+        print(f'holdup: Serving readiness on {server.url} for these services: {", ".join(map(brief_representer, options.service))}')
+    try:
+        engine.watch(options.service)
+    finally:
+        server.stop()
@@ -0,0 +1,104 @@
+import socket
+import threading
+from time import time
+
+from . import net
+
+
+class Resolver:
+    """
+    A ``getaddrinfo`` cache shared by all the checks.
+
+    Successful lookups are kept for ``ttl`` seconds. Once expired they are still used while a new lookup is done in
+    the background. Failed lookups are kept for ``negative_ttl`` seconds (but never longer than ``ttl``). A ``ttl`` of
+    zero disables caching.
+    """
+
+    def __init__(self, ttl=30.0, negative_ttl=1.0):
+        self.ttl = ttl
+        self.negative_ttl = min(ttl, negative_ttl)
+        self.cache = {}
+        self.refreshing = set()
+        self.lock = threading.Lock()
+
+    def getaddrinfo(self, host, port, family=0, socktype=0):
+        key = host, port, family, socktype
+        addresses = self.cached(key)
+        if addresses is None:
+            addresses = self.lookup(key)
+        return addresses
+
+    async def agetaddrinfo(self, host, port, family=0, socktype=0):
+        key = host, port, family, socktype
+        addresses = self.cached(key)
+        if addresses is None:
+            import asyncio
+
+            try:
+                addresses = await asyncio.get_running_loop().getaddrinfo(host, port, family=family, type=socktype)
+            except socket.gaierror as exc:
+                self.remember(key, error=exc)
+                raise
+            self.remember(key, addresses)
+        return addresses
+
+    def cached(self, key):
+        """
+        Returns:
+            list: The cached addresses or ``None`` if a lookup needs to be done.
+
+        Raises:
+            socket.gaierror: If the lookup failed recently.
+        """
+        if self.ttl <= 0:
+            return
+        with self.lock:
+            entry = self.cache.get(key)
+        if entry is None:
+            return
+        expires, addresses, error = entry
+        if time() < expires:
+            if error:
+                raise socket.gaierror(*error.args)
+            return addresses
+        elif addresses:
+            self.refresh(key)
+            return addresses
+
+    def lookup(self, key):
+        try:
+            addresses = socket.getaddrinfo(*key)
+        except socket.gaierror as exc:
+            self.remember(key, error=exc)
+            raise
+        self.remember(key, addresses)
+        return addresses
+
+    def remember(self, key, addresses=None, error=None):
+        if self.ttl > 0:
+            with self.lock:
+                self.cache[key] = time() + (self.negative_ttl if error else self.ttl), addresses, error
+
+    def refresh(self, key):
+        with self.lock:
+            if key in self.refreshing:
+                return
+            self.refreshing.add(key)
+
+        def lookup():
+            try:
+                self.lookup(key)
+            except OSError:
+                pass
+            finally:
+                with self.lock:
+                    self.refreshing.discard(key)
+
+        threading.Thread(target=lookup, name=f"holdup-dns-{key[0]}", daemon=True).start()
+
+    def create_connection(self, address, timeout=None, source_address=None):
+        """
+        Same as :func:`socket.create_connection` but with cached lookups and Happy Eyeballs.
+        """
+        host, port = address
+        return net.connect(self.getaddrinfo(host, port, 0, socket.SOCK_STREAM), timeout, source_address)
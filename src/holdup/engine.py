@@ -0,0 +1,365 @@
+import random
+import socket
+from heapq import heappop
+from heapq import heappush
+from itertools import count
+from queue import Empty
+from queue import SimpleQueue
+from time import time
+
+from .executor import DaemonExecutor
+from .report import Report
+
+# how long after --check-timeout (or the deadline) an attempt is abandoned: checks that honor the timeout get to report
+# their own error
+DEADLINE_SLACK = 0.1
+
+
+class Engine:
+    """
+    Runs checks until they all pass or the timeout expires.
+
+    Every check is retried ``--interval`` seconds after its own previous attempt finished, thus a slow check doesn't
+    delay the other checks. All checks are attempted at least once, even if the timeout is zero.
+
+    No attempt outlives ``--check-timeout`` (nor the deadline, except the first attempt of a check) by more than
+    :data:`DEADLINE_SLACK`: attempts stuck longer than that are abandoned (their thread keeps running, the check fails
+    with "timed out") and the check is only attempted again once the stuck attempt returned.
+    """
+
+    watcher = None
+
+    def __init__(self, options):
+        self.options = options
+        self.report = Report()
+        self.stopping = False
+
+    def setting(self, check, name):
+        value = getattr(check, name)
+        if value is None:
+            return getattr(self.options, name)
+        else:
+            return value
+
+    def delay(self, check, failures):
+        """
+        Returns:
+            float: How long to sleep before the next attempt of the check, after it failed ``failures`` times in a row.
+        """
+        delay = self.setting(check, "interval")
+        if self.setting(check, "backoff") == "exponential":
+            # the exponent is capped, a float overflows after about 1024 doublings
+            delay = min(delay * 2 ** min(failures - 1, 63), self.setting(check, "max_interval"))
+        jitter = self.setting(check, "jitter")
+        if jitter:
+            delay *= 1 + jitter * (2 * random.random() - 1)  # noqa: S311
+        return delay
+
+    def retry_delay(self, check, failures, deadline, watched):
+        """
+        Like :meth:`delay` but ``None`` if there's no time left for another attempt before the deadline. Watched checks
+        (see :meth:`arm`) still poll, the watcher only wakes them up sooner, thus they sleep until the deadline at most.
+        """
+        delay = self.delay(check, failures)
+        if deadline is not None:
+            remaining = deadline - time()
+            if watched and remaining > 0:
+                delay = min(delay, remaining)
+            elif delay >= remaining:
+                return None
+        return delay
+
+    def attempt_deadline(self, start, first, deadline):
+        """
+        Returns:
+            float: When an attempt that started at ``start`` gets abandoned.
+        """
+        limit = start + self.options.check_timeout
+        if deadline is not None and not first:
+            limit = min(limit, deadline)
+        return limit + DEADLINE_SLACK
+
+    def abandon(self, check, start):
+        check.error = socket.timeout("timed out")
+        self.report.attempt(check, start, time())
+
+    def arm(self, check):
+        """
+        Makes the watcher call :meth:`wake` when the path the failed check waits for changes.
+
+        Returns:
+            bool: ``True`` if the check is watched.
+        """
+        if self.options.no_watch:
+            return False
+        path = check.watch_path()
+        if path is None:
+            return False
+        if self.watcher is None:
+            from .inotify import Watcher
+
+            try:
+                self.watcher = Watcher(self.wake)
+            except OSError:
+                self.options.no_watch = True  # fall back to polling
+                return False
+        return self.watcher.watch(check, path, missing=isinstance(check.error, FileNotFoundError))
+
+    def wake(self, check):
+        """
+        Called from the watcher's thread.
+        """
+        raise NotImplementedError
+
+    def close(self):
+        """
+        Stops the watcher and closes what the checks kept open.
+        """
+        if self.watcher is not None:
+            self.watcher.close()
+            self.watcher = None
+        if self.options.pg_pool:
+            self.options.pg_pool.close()
+        for worker in self.options.eval_workers:
+            worker.stop()
+
+    def attempt(self, check):
+        start = time()
+        cache = self.options.cache
+        if cache and cache.fresh(check):
+            passed = check.passed(self.options)
+        else:
+            passed = check.is_passing(self.options)
+            if passed and cache:
+                cache.publish(check)
+        self.report.attempt(check, start, time())
+        return passed
+
+    async def aattempt(self, check):
+        start = time()
+        cache = self.options.cache
+        if cache and cache.fresh(check):
+            passed = check.passed(self.options)
+        else:
+            passed = await check.ais_passing(self.options)
+            if passed and cache:
+                cache.publish(check)
+        self.report.attempt(check, start, time())
+        return passed
+
+    def wait(self, checks):
+        """
+        Returns:
+            list: The checks that did not pass.
+        """
+        raise NotImplementedError
+
+    def watch(self, checks):
+        """
+        Keeps checking (passing checks too, every ``--interval``) until :meth:`stop` is called.
+        """
+        raise NotImplementedError
+
+    def stop(self):
+        """
+        Makes :meth:`watch` return (after the running checks finish). Can be called from a signal handler.
+        """
+        self.stopping = True
+
+
+class ThreadEngine(Engine):
+    def __init__(self, options):
+        super().__init__(options)
+        # finished futures, checks woken up by the watcher and None (stop)
+        self.events = SimpleQueue()
+
+    def wait(self, checks):
+        return self.run(checks, time() + self.options.timeout)
+
+    def watch(self, checks):
+        self.run(checks, None)
+
+    def stop(self):
+        super().stop()
+        self.events.put(None)
+
+    def wake(self, check):
+        self.events.put(check)
+
+    def run(self, checks, deadline):
+        """
+        Runs the checks until they all pass or the deadline (if ``None``, until stopped: passing checks get scheduled
+        again).
+
+        Returns:
+            list: The checks that did not pass.
+        """
+        options = self.options
+        concurrency = options.concurrency
+        pending = set(checks)
+        sequence = count()
+        schedule = []
+        scheduled = {}  # check -> sequence number of its entry in the schedule, older entries are skipped
+        asleep = {}  # check -> when it started sleeping, reported once it's due or woken up
+        failures = dict.fromkeys(checks, 0)
+        attempted = set()
+        running = {}  # future -> check, abandoned attempts included
+        limits = {}  # future -> (start, when it gets abandoned) of the attempts not abandoned yet
+        stuck = set()  # checks with an abandoned attempt still running
+        events = self.events
+        executor = DaemonExecutor()
+
+        def push(due, check):
+            scheduled[check] = number = next(sequence)
+            heappush(schedule, (due, number, check))
+
+        def done(check, passed):
+            if passed:
+                pending.discard(check)
+                if deadline is not None:
+                    return
+                failures[check] = 0
+                delay = self.delay(check, 1)
+            else:
+                pending.add(check)
+                failures[check] += 1
+                delay = self.retry_delay(check, failures[check], deadline, self.arm(check))
+            if delay is not None:
+                asleep[check] = now = time()
+                push(now + delay, check)
+
+        for check in checks:
+            push(time(), check)
+        try:
+            while (scheduled or limits or (stuck and (deadline is None or time() < deadline))) and not self.stopping:
+                now = time()
+                while schedule and schedule[0][0] <= now and len(limits) < concurrency:
+                    due, number, check = heappop(schedule)
+                    if scheduled.get(check) == number:
+                        del scheduled[check]
+                        if check in asleep:
+                            self.report.sleep(check, due - asleep.pop(check))
+                        if check in stuck:
+                            continue  # attempted again when the stuck attempt returns
+                        future = executor.submit(self.attempt, check)
+                        running[future] = check
+                        limits[future] = now, self.attempt_deadline(now, check not in attempted, deadline)
+                        attempted.add(check)
+                        future.add_done_callback(events.put)
+                wakeups = [limit for _, limit in limits.values()]
+                if schedule and len(limits) < concurrency:
+                    wakeups.append(schedule[0][0])
+                if stuck and deadline is not None:
+                    wakeups.append(deadline)
+                try:
+                    event = events.get(timeout=max(0, min(wakeups) - now) if wakeups else None)
+                except Empty:
+                    event = None
+                if event in running:
+                    check = running.pop(event)
+                    if limits.pop(event, None) is None:  # abandoned, but it counts
+                        stuck.discard(check)
+                    done(check, event.result())
+                elif event is not None:  # woken up by the watcher
+                    if event in pending and event not in running.values():
+                        push(time(), event)
+                now = time()
+                for future, (start, limit) in list(limits.items()):
+                    if limit <= now:
+                        del limits[future]
+                        check = running[future]
+                        stuck.add(check)
+                        self.abandon(check, start)
+                        done(check, False)
+        finally:
+            executor.shutdown(wait=False)
+            self.close()
+        return [check for check in checks if check in pending]
+
+
+class AsyncEngine(Engine):
+    loop = task = None
+
+    def wait(self, checks):
+        import asyncio
+
+        return asyncio.run(self.await_checks(checks, time() + self.options.timeout))
+
+    def watch(self, checks):
+        import asyncio
+
+        try:
+            asyncio.run(self.await_checks(checks, None))
+        except asyncio.CancelledError:
+            pass
+
+    def stop(self):
+        super().stop()
+        if self.task and not self.task.done():
+            self.loop.call_soon_threadsafe(self.task.cancel)
+
+    def wake(self, check):
+        self.loop.call_soon_threadsafe(self.wakeups[check].set)
+
+    async def await_checks(self, checks, deadline):
+        """
+        Same as :meth:`ThreadEngine.run`.
+        """
+        import asyncio
+
+        options = self.options
+        semaphore = asyncio.Semaphore(options.concurrency)
+        self.loop = asyncio.get_running_loop()
+        # the threads of the checks without an async implementation can be abandoned
+        self.loop.set_default_executor(DaemonExecutor())
+        self.task = asyncio.current_task()
+        self.wakeups = {check: asyncio.Event() for check in checks}
+
+        async def keep_checking(check):
+            failures = 0
+            attempt = None
+            wakeup = self.wakeups[check]
+            while not self.stopping:
+                async with semaphore:
+                    start = time()
+                    if attempt is None or attempt.done():  # otherwise, wait some more for the abandoned attempt
+                        attempt = asyncio.ensure_future(self.aattempt(check))
+                    limit = self.attempt_deadline(start, failures == 0, deadline)
+                    finished, _ = await asyncio.wait({attempt}, timeout=max(0, limit - time()))
+                    if finished:
+                        passed = attempt.result()
+                    else:
+                        self.abandon(check, start)
+                        passed = False
+                    if passed:
+                        if deadline is not None:
+                            return True
+                        failures = 0
+                        delay = self.delay(check, 1)
+                    else:
+                        failures += 1
+                        wakeup.clear()
+                        delay = self.retry_delay(check, failures, deadline, self.arm(check))
+                if delay is None:
+                    return False
+                asleep = time()
+                try:
+                    await asyncio.wait_for(wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                self.report.sleep(check, time() - asleep)
+            return check.error is False
+
+        try:
+            results = await asyncio.gather(*map(keep_checking, checks))
+        finally:
+            self.close()
+            # the pooled streams belong to this event loop
+            options.http_pool.close()
+        return [check for check, passed in zip(checks, results) if not passed]
+
+
+ENGINES = {
+    "thread": ThreadEngine,
+    "async": AsyncEngine,
+}
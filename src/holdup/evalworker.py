@@ -0,0 +1,142 @@
+"""
+The ``--eval-worker`` subprocess: it imports the modules an ``eval://`` expression uses once, then evaluates the
+expression whenever it gets a line on stdin and answers with a line of JSON on stdout. Slow imports thus don't delay
+holdup's other checks and an evaluation that takes longer than ``--check-timeout`` can be stopped by killing the worker.
+
+The worker exits when its stdin is closed, which happens when holdup exits or execs the command.
+"""
+
+import json
+import os
+import selectors
+import socket
+import subprocess
+import sys
+from time import time
+
+from .checks import EvalCheck
+
+READY = b"ready\n"
+
+
+class EvalWorker:
+    """
+    Starts a worker process for the expression right away, so it imports while the other checks run. The imports
+    aren't bound by the check timeout (attempts fail while the worker is starting, without killing it), only the
+    evaluations are.
+    """
+
+    def __init__(self, expr):
+        self.expr = expr
+        self.process = None
+        self.start()
+
+    def start(self):
+        if getattr(sys, "frozen", False):
+            # sys.executable is the holdup binary (eg: PyInstaller), which has a hidden command for the worker
+            from .cli import EVAL_WORKER_COMMAND
+
+            args, env = [sys.executable, EVAL_WORKER_COMMAND, self.expr], None
+        else:
+            args = [sys.executable, "-m", "holdup.evalworker", self.expr]
+            # same module search path as this process (the holdup script's directory isn't the current directory)
+            env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+        self.process = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=subprocess.PIPE, env=env)
+        self.ready = False
+        self.buffer = b""
+
+    def readline(self, deadline):
+        """
+        Returns:
+            bytes: The next line from the worker or ``None`` if the deadline passed.
+
+        Raises:
+            Exception: If the worker exited.
+        """
+        fd = self.process.stdout.fileno()
+        with selectors.DefaultSelector() as selector:
+            selector.register(fd, selectors.EVENT_READ)
+            while b"\n" not in self.buffer:
+                remaining = deadline - time()
+                if remaining <= 0 or not selector.select(remaining):
+                    return None
+                data = os.read(fd, 65536)
+                if not data:
+                    returncode = self.stop()
+                    raise Exception(f"Eval worker exited with code {returncode}")
+                self.buffer += data
+        line, self.buffer = self.buffer.split(b"\n", 1)
+        return line + b"\n"
+
+    def evaluate(self, timeout):
+        """
+        Raises:
+            Exception: With the error of the evaluation (or the falsey result) as message.
+        """
+        deadline = time() + timeout
+        if self.process is None:
+            self.start()
+        if not self.ready:
+            if self.readline(deadline) is None:
+                raise socket.timeout("timed out (the eval worker is still starting)")
+            self.ready = True
+        try:
+            self.process.stdin.write(b"\n")
+            self.process.stdin.flush()
+        except BrokenPipeError:
+            pass  # the worker exited, readline will tell
+        line = self.readline(deadline)
+        if line is None:
+            self.stop()
+            raise socket.timeout("timed out")
+        error = json.loads(line)["error"]
+        if error:
+            raise Exception(error)
+
+    def stop(self):
+        """
+        Kills the worker, a new one is started for the next evaluation.
+
+        Returns:
+            int: The exit code of the worker.
+        """
+        process, self.process = self.process, None
+        if process is None:
+            return None
+        process.kill()
+        try:
+            process.stdin.close()
+        except BrokenPipeError:
+            pass
+        process.stdout.close()
+        return process.wait()
+
+
+def main(expr):
+    # what the expression prints must not get mixed up with the answers
+    channel = os.fdopen(os.dup(sys.stdout.fileno()), "wb", buffering=0)
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+
+    check = EvalCheck(expr)
+    try:
+        check.import_names()
+    except Exception as exc:
+        import_error = str(exc)
+    else:
+        import_error = None
+    channel.write(READY)
+    for _ in sys.stdin.buffer:
+        if import_error:
+            error = import_error
+        else:
+            try:
+                check.run(None)
+            except Exception as exc:
+                error = str(exc) or repr(exc)
+            else:
+                error = None
+        channel.write(json.dumps({"error": error}).encode() + b"\n")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1])
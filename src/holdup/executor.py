@@ -0,0 +1,61 @@
+import threading
+from concurrent.futures import Future
+from concurrent.futures import ThreadPoolExecutor
+from queue import SimpleQueue
+
+
+class DaemonExecutor(ThreadPoolExecutor):
+    """
+    Like a ``ThreadPoolExecutor`` without a limit on the number of threads (idle threads are reused) but the threads are
+    daemons and :meth:`shutdown` never waits: a probe stuck past its deadline (on a hung NFS mount, in a DNS lookup or in
+    an ``eval://`` expression) is abandoned and doesn't keep holdup from exiting.
+
+    It only subclasses ``ThreadPoolExecutor`` (none of its implementation is used) because asyncio only accepts those
+    as default executor.
+    """
+
+    def __init__(self, name="holdup-probe"):  # super().__init__ isn't called on purpose
+        self.name = name
+        self.tasks = SimpleQueue()
+        self.lock = threading.Lock()
+        self.idle = 0
+        self.closed = False
+
+    def submit(self, fn, /, *args, **kwargs):
+        future = Future()
+        with self.lock:
+            if self.closed:
+                raise RuntimeError("cannot schedule new futures after shutdown")
+            if self.idle:
+                self.idle -= 1
+            else:
+                threading.Thread(target=self.work, name=self.name, daemon=True).start()
+        self.tasks.put((future, fn, args, kwargs))
+        return future
+
+    def work(self):
+        while True:
+            task = self.tasks.get()
+            if task is None:
+                return
+            future, fn, args, kwargs = task
+            if future.set_running_or_notify_cancel():
+                try:
+                    result = fn(*args, **kwargs)
+                except BaseException as exc:
+                    future.set_exception(exc)
+                else:
+                    future.set_result(result)
+            del task, future, fn, args, kwargs
+            with self.lock:
+                if self.closed:
+                    return
+                self.idle += 1
+
+    def shutdown(self, wait=True, *, cancel_futures=False):
+        # never waits, the busy threads exit when their call returns
+        with self.lock:
+            self.closed = True
+            idle, self.idle = self.idle, 0
+        for _ in range(idle):
+            self.tasks.put(None)
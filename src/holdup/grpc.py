@@ -0,0 +1,516 @@
+"""
+The :class:`GrpcCheck`: calls the standard health service (``grpc.health.v1.Health/Check``) with a minimal HTTP/2
+client, over a plain socket (h2c, with prior knowledge) or TLS (ALPN ``h2``), thus it doesn't need grpcio. Only a
+``SERVING`` status passes.
+
+The client makes a single call and only implements what it needs to read the response: HPACK decoding (servers use
+Huffman coding and the dynamic table) but no flow control (the response is tiny).
+"""
+
+import argparse
+import socket
+import struct
+from contextlib import closing
+from functools import lru_cache
+from urllib.parse import unquote
+from urllib.parse import urlparse
+
+from . import __version__
+from . import net
+from .checks import Check
+
+PREFACE = b"PRI * HTTP/2.0\r\n\r\nSM\r\n\r\n"
+HEALTH_CHECK_PATH = "/grpc.health.v1.Health/Check"
+STREAM_ID = 1
+
+# frame types
+DATA = 0x0
+HEADERS = 0x1
+RST_STREAM = 0x3
+SETTINGS = 0x4
+PING = 0x6
+GOAWAY = 0x7
+CONTINUATION = 0x9
+
+# frame flags
+END_STREAM = 0x1
+ACK = 0x1
+END_HEADERS = 0x4
+PADDED = 0x8
+PRIORITY = 0x20
+
+SETTINGS_ENABLE_PUSH = 0x2
+
+ERROR_CODES = (
+    "NO_ERROR PROTOCOL_ERROR INTERNAL_ERROR FLOW_CONTROL_ERROR SETTINGS_TIMEOUT STREAM_CLOSED FRAME_SIZE_ERROR "
+    "REFUSED_STREAM CANCEL COMPRESSION_ERROR CONNECT_ERROR ENHANCE_YOUR_CALM INADEQUATE_SECURITY HTTP_1_1_REQUIRED"
+).split()
+GRPC_STATUS_CODES = (
+    "OK CANCELLED UNKNOWN INVALID_ARGUMENT DEADLINE_EXCEEDED NOT_FOUND ALREADY_EXISTS PERMISSION_DENIED RESOURCE_EXHAUSTED "
+    "FAILED_PRECONDITION ABORTED OUT_OF_RANGE UNIMPLEMENTED INTERNAL UNAVAILABLE DATA_LOSS UNAUTHENTICATED"
+).split()
+SERVING_STATUSES = "UNKNOWN SERVING NOT_SERVING SERVICE_UNKNOWN".split()
+SERVING = 1
+
+# RFC 7541 appendix A
+STATIC_TABLE = (
+    (":authority", ""),
+    (":method", "GET"),
+    (":method", "POST"),
+    (":path", "/"),
+    (":path", "/index.html"),
+    (":scheme", "http"),
+    (":scheme", "https"),
+    (":status", "200"),
+    (":status", "204"),
+    (":status", "206"),
+    (":status", "304"),
+    (":status", "400"),
+    (":status", "404"),
+    (":status", "500"),
+    ("accept-charset", ""),
+    ("accept-encoding", "gzip, deflate"),
+    ("accept-language", ""),
+    ("accept-ranges", ""),
+    ("accept", ""),
+    ("access-control-allow-origin", ""),
+    ("age", ""),
+    ("allow", ""),
+    ("authorization", ""),
+    ("cache-control", ""),
+    ("content-disposition", ""),
+    ("content-encoding", ""),
+    ("content-language", ""),
+    ("content-length", ""),
+    ("content-location", ""),
+    ("content-range", ""),
+    ("content-type", ""),
+    ("cookie", ""),
+    ("date", ""),
+    ("etag", ""),
+    ("expect", ""),
+    ("expires", ""),
+    ("from", ""),
+    ("host", ""),
+    ("if-match", ""),
+    ("if-modified-since", ""),
+    ("if-none-match", ""),
+    ("if-range", ""),
+    ("if-unmodified-since", ""),
+    ("last-modified", ""),
+    ("link", ""),
+    ("location", ""),
+    ("max-forwards", ""),
+    ("proxy-authenticate", ""),
+    ("proxy-authorization", ""),
+    ("range", ""),
+    ("referer", ""),
+    ("refresh", ""),
+    ("retry-after", ""),
+    ("server", ""),
+    ("set-cookie", ""),
+    ("strict-transport-security", ""),
+    ("transfer-encoding", ""),
+    ("user-agent", ""),
+    ("vary", ""),
+    ("via", ""),
+    ("www-authenticate", ""),
+)
+
+# RFC 7541 appendix B: the bit length of each symbol's code (the last one is EOS). The code is canonical (codes of the
+# same length are consecutive, in symbol order) so the lengths are enough to rebuild it.
+HUFFMAN_CODE_LENGTHS = bytes.fromhex(
+    "0d171c1c1c1c1c1c1c181e1c1c1e1c1c1c1c1c1c1c1c1e1c1c1c1c1c1c1c1c1c"
+    "060a0a0c0d06080b0a0a080b080606060505050606060606060607080f060c0a"
+    "0d06070707070707070707070707070707070707070707070807080d130d0e06"
+    "0f05060506050606060507070606060506070605050607070707070f0b0e0d1c"
+    "1416141416161617161717171717181718181617181717171715161716171718"
+    "1615141616171715171616181516171715151615171617171416161617161617"
+    "1a1a1413161716191a1a1a1b1b1a181913151a1b1b1a1b1815151a1a1c1b1b1b"
+    "14181415161515171616191918181a171a1b1a1a1b1b1b1b1b1c1b1b1b1b1b1a"
+    "1e"
+)
+EOS = 256
+
+
+def code_name(names, code):
+    return names[code] if 0 <= code < len(names) else str(code)
+
+
+def encode_varint(value):
+    encoded = bytearray()
+    while value >= 0x80:
+        encoded.append(value & 0x7F | 0x80)
+        value >>= 7
+    encoded.append(value)
+    return bytes(encoded)
+
+
+def decode_varint(data, position):
+    """
+    Returns:
+        tuple: The (little-endian base 128) integer at the position and the position after it.
+    """
+    value = shift = 0
+    while True:
+        byte = data[position]
+        position += 1
+        value |= (byte & 0x7F) << shift
+        shift += 7
+        if not byte & 0x80:
+            return value, position
+
+
+def encode_integer(value, prefix, flags=0):
+    mask = (1 << prefix) - 1
+    if value < mask:
+        return bytes([flags | value])
+    return bytes([flags | mask]) + encode_varint(value - mask)
+
+
+def decode_integer(data, position, prefix):
+    """
+    Returns:
+        tuple: The HPACK integer (with a ``prefix`` bits prefix) at the position and the position after it.
+    """
+    mask = (1 << prefix) - 1
+    value = data[position] & mask
+    if value < mask:
+        return value, position + 1
+    rest, position = decode_varint(data, position + 1)
+    return value + rest, position
+
+
+@lru_cache(maxsize=None)
+def huffman_codes():
+    """
+    Returns:
+        dict: The symbol for each ``(length, code)``.
+    """
+    codes = {}
+    code = length = 0
+    for symbol in sorted(range(len(HUFFMAN_CODE_LENGTHS)), key=lambda symbol: (HUFFMAN_CODE_LENGTHS[symbol], symbol)):
+        code <<= HUFFMAN_CODE_LENGTHS[symbol] - length
+        length = HUFFMAN_CODE_LENGTHS[symbol]
+        codes[length, code] = symbol
+        code += 1
+    return codes
+
+
+def huffman_decode(data):
+    codes = huffman_codes()
+    decoded = bytearray()
+    code = length = 0
+    for byte in data:
+        for shift in range(7, -1, -1):
+            code = code << 1 | byte >> shift & 1
+            length += 1
+            symbol = codes.get((length, code))
+            if symbol == EOS or length > 30:
+                raise ValueError("Invalid Huffman code")
+            elif symbol is not None:
+                decoded.append(symbol)
+                code = length = 0
+    if length > 7 or code != (1 << length) - 1:
+        raise ValueError("Invalid Huffman padding")
+    return bytes(decoded)
+
+
+def decode_string(data, position):
+    huffman = data[position] & 0x80
+    length, position = decode_integer(data, position, 7)
+    value = data[position : position + length]
+    if len(value) < length:
+        raise IndexError("string out of range")
+    if huffman:
+        value = huffman_decode(value)
+    return value.decode("latin-1"), position + length
+
+
+def encode_headers(headers):
+    """
+    Every header as a literal without indexing, with a literal name and no Huffman coding: bigger than needed, but the
+    request is sent once per connection anyway.
+    """
+    block = b""
+    for name, value in headers:
+        block += b"\0"
+        for string in (name.encode(), value.encode()):
+            block += encode_integer(len(string), 7) + string
+    return block
+
+
+class HeaderDecoder:
+    """
+    HPACK (`RFC 7541 <https://datatracker.ietf.org/doc/html/rfc7541>`_) decoding. The dynamic table lives as long as the
+    connection, thus all the header blocks received on it have to go through the same decoder.
+    """
+
+    def __init__(self, max_size=4096):
+        self.dynamic_table = []  # newest first
+        self.size = 0
+        self.max_size = max_size
+
+    def lookup(self, index):
+        if 0 < index <= len(STATIC_TABLE):
+            return STATIC_TABLE[index - 1]
+        elif 0 < index - len(STATIC_TABLE) <= len(self.dynamic_table):
+            return self.dynamic_table[index - len(STATIC_TABLE) - 1]
+        else:
+            raise ValueError(f"Invalid header table index: {index}")
+
+    def add(self, name, value):
+        self.dynamic_table.insert(0, (name, value))
+        self.size += len(name) + len(value) + 32
+        self.evict()
+
+    def evict(self):
+        while self.size > self.max_size:
+            name, value = self.dynamic_table.pop()
+            self.size -= len(name) + len(value) + 32
+
+    def decode(self, block):
+        """
+        Returns:
+            list: The ``(name, value)`` tuples.
+        """
+        headers = []
+        position = 0
+        try:
+            while position < len(block):
+                byte = block[position]
+                if byte & 0x80:  # indexed
+                    index, position = decode_integer(block, position, 7)
+                    headers.append(self.lookup(index))
+                elif byte & 0xE0 == 0x20:  # dynamic table size update
+                    self.max_size, position = decode_integer(block, position, 5)
+                    self.evict()
+                else:  # literal, with incremental indexing or without (never indexed is the same for a decoder)
+                    indexing = byte & 0x40
+                    index, position = decode_integer(block, position, 6 if indexing else 4)
+                    if index:
+                        name = self.lookup(index)[0]
+                    else:
+                        name, position = decode_string(block, position)
+                    value, position = decode_string(block, position)
+                    if indexing:
+                        self.add(name, value)
+                    headers.append((name, value))
+        except IndexError:
+            raise ValueError("Truncated header block") from None
+        return headers
+
+
+def frame(kind, flags, stream_id, payload=b""):
+    return len(payload).to_bytes(3, "big") + struct.pack("!BBI", kind, flags, stream_id) + payload
+
+
+def frame_header(header):
+    """
+    Returns:
+        tuple: The payload length, kind, flags and stream id.
+    """
+    kind, flags, stream_id = struct.unpack_from("!BBI", header, 3)
+    return int.from_bytes(header[:3], "big"), kind, flags, stream_id & 0x7FFFFFFF
+
+
+def unpad(flags, payload):
+    if flags & PADDED:
+        payload = payload[1 : len(payload) - payload[0]]
+    return payload
+
+
+def health_check_request(service):
+    """
+    Returns:
+        bytes: A ``HealthCheckRequest`` message, in its gRPC framing.
+    """
+    message = b""
+    if service:
+        service = service.encode()
+        message = b"\x0a" + encode_varint(len(service)) + service  # field 1, length-delimited
+    return struct.pack("!BI", 0, len(message)) + message
+
+
+def serving_status(body):
+    """
+    Returns:
+        int: The status in a ``HealthCheckResponse`` message (in its gRPC framing).
+    """
+    if len(body) < 5:
+        raise ValueError("Truncated gRPC message")
+    compressed, length = struct.unpack_from("!BI", body)
+    if compressed:
+        raise ValueError("Unexpected compressed gRPC message")
+    message = body[5 : 5 + length]
+    status = position = 0  # proto3 leaves out default values: no field means UNKNOWN
+    try:
+        while position < len(message):
+            key, position = decode_varint(message, position)
+            wire_type = key & 0x7
+            if wire_type == 0:
+                value, position = decode_varint(message, position)
+                if key >> 3 == 1:
+                    status = value
+            elif wire_type == 1:
+                position += 8
+            elif wire_type == 2:
+                length, position = decode_varint(message, position)
+                position += length
+            elif wire_type == 5:
+                position += 4
+            else:
+                raise ValueError(f"Unsupported protobuf wire type: {wire_type}")
+    except IndexError:
+        raise ValueError("Truncated protobuf message") from None
+    return status
+
+
+def conversation(scheme, authority, service):
+    """
+    The HTTP/2 client making the health check call, for :func:`holdup.net.converse` (with :func:`frame_header`).
+
+    Yields:
+        bytes: What to send to the server (possibly nothing) before sending back the next frame received, as a
+            ``(kind, flags, stream_id, payload)`` tuple.
+
+    Returns:
+        bytes: What to send to the server before closing the connection.
+    """
+    headers = [
+        (":method", "POST"),
+        (":scheme", scheme),
+        (":path", HEALTH_CHECK_PATH),
+        (":authority", authority),
+        ("content-type", "application/grpc"),
+        ("te", "trailers"),
+        ("user-agent", f"python-holdup/{__version__}"),
+    ]
+    decoder = HeaderDecoder()
+    header_blocks = []  # the response headers, then the trailers
+    fragment = None  # a header block waiting for its CONTINUATION frames
+    body = b""
+    ended = False
+    kind, flags, stream_id, payload = yield (
+        PREFACE
+        + frame(SETTINGS, 0, 0, struct.pack("!HI", SETTINGS_ENABLE_PUSH, 0))
+        + frame(HEADERS, END_HEADERS, STREAM_ID, encode_headers(headers))
+        + frame(DATA, END_STREAM, STREAM_ID, health_check_request(service))
+    )
+    while True:
+        reply = b""
+        if kind == SETTINGS and not flags & ACK:
+            reply = frame(SETTINGS, ACK, 0)
+        elif kind == PING and not flags & ACK:
+            reply = frame(PING, ACK, 0, payload)
+        elif kind == GOAWAY:
+            last_stream_id, code = struct.unpack_from("!II", payload)
+            if last_stream_id & 0x7FFFFFFF < STREAM_ID:  # otherwise the call still completes
+                raise Exception(f"The server refused the call (GOAWAY with {code_name(ERROR_CODES, code)})")
+        elif stream_id == STREAM_ID:
+            if kind == RST_STREAM:
+                (code,) = struct.unpack("!I", payload)
+                raise Exception(f"The server reset the stream ({code_name(ERROR_CODES, code)})")
+            elif kind == HEADERS:
+                fragment = unpad(flags, payload)[5 if flags & PRIORITY else 0 :]
+                ended = flags & END_STREAM
+            elif kind == CONTINUATION:
+                fragment += payload
+            elif kind == DATA:
+                body += unpad(flags, payload)
+                ended = flags & END_STREAM
+            if kind in (HEADERS, CONTINUATION) and flags & END_HEADERS:
+                header_blocks.append(dict(decoder.decode(fragment)))
+                fragment = None
+            if ended and fragment is None:
+                break
+        kind, flags, stream_id, payload = yield reply
+
+    response_headers = header_blocks[0] if header_blocks else {}
+    trailers = header_blocks[-1] if header_blocks else {}
+    if response_headers.get(":status") != "200":
+        raise Exception(f"Expected HTTP status 200, got {response_headers.get(':status')}")
+    grpc_status = trailers.get("grpc-status")
+    if grpc_status is None:
+        raise Exception("The response has no grpc-status")
+    elif grpc_status != "0":
+        error = f"gRPC error {code_name(GRPC_STATUS_CODES, int(grpc_status))}"
+        grpc_message = unquote(trailers.get("grpc-message", ""))
+        raise Exception(f"{error}: {grpc_message}" if grpc_message else error)
+    status = serving_status(body)
+    if status != SERVING:
+        raise Exception(f"Health status is {code_name(SERVING_STATUSES, status)}")
+    return frame(GOAWAY, 0, 0, struct.pack("!II", STREAM_ID, 0))
+
+
+class GrpcCheck(Check):
+    """
+    The service to check is the url's path (eg: ``grpc://host:port/package.Service``), without one the server's overall
+    health is checked.
+    """
+
+    def __init__(self, url):
+        self.url = url
+        parsed_url = urlparse(url)
+        self.tls = parsed_url.scheme != "grpc"
+        self.insecure = parsed_url.scheme == "grpcs+insecure"
+        try:
+            self.port = parsed_url.port or (443 if self.tls else 80)
+        except ValueError as exc:
+            raise argparse.ArgumentTypeError(f"Invalid service spec {url!r}. {exc}.") from None
+        self.host = parsed_url.hostname
+        if not self.host:
+            raise argparse.ArgumentTypeError(f"Invalid service spec {url!r}. Must have a host.")
+        if parsed_url.query:
+            raise argparse.ArgumentTypeError(f"Invalid service spec {url!r}. Unknown parameters: {parsed_url.query}.")
+        self.authority = parsed_url.netloc
+        self.service = unquote(parsed_url.path.lstrip("/"))
+
+    def ssl_context(self, options):
+        return net.ssl_context(self.insecure or options.insecure, alpn_protocols=("h2",))
+
+    def check_alpn(self, ssl_object):
+        if ssl_object.selected_alpn_protocol() != "h2":
+            raise Exception("The server doesn't support HTTP/2 (ALPN h2 not selected)")
+
+    def steps(self):
+        return conversation("https" if self.tls else "http", self.authority, self.service)
+
+    def run(self, options):
+        addresses = options.resolver.getaddrinfo(self.host, self.port, 0, socket.SOCK_STREAM)
+        sock = net.connect(addresses, options.check_timeout)
+        with closing(sock):
+            if self.tls:
+                sock = self.ssl_context(options).wrap_socket(sock, server_hostname=self.host)
+                self.check_alpn(sock)
+            with closing(sock):
+                net.converse(sock, self.steps(), 9, frame_header)
+
+    async def arun(self, options):
+        import asyncio
+
+        await asyncio.wait_for(self.aprobe(options), options.check_timeout)
+
+    async def aprobe(self, options):
+        import asyncio
+
+        addresses = await options.resolver.agetaddrinfo(self.host, self.port, 0, socket.SOCK_STREAM)
+        sock = await net.aconnect(addresses)
+        try:
+            ssl_context = self.ssl_context(options) if self.tls else None
+            reader, writer = await asyncio.open_connection(sock=sock, ssl=ssl_context, server_hostname=self.host if ssl_context else None)
+        except BaseException:
+            sock.close()
+            raise
+        try:
+            if ssl_context:
+                self.check_alpn(writer.get_extra_info("ssl_object"))
+            await net.aconverse(reader, writer, self.steps(), 9, frame_header)
+        finally:
+            writer.close()
+
+    def __repr__(self):
+        return f"GrpcCheck({self.url}, status={self.status})"
+
+    def display_definition(self, **_):
+        return self.url
@@ -0,0 +1,532 @@
+"""
+The :class:`HttpCheck` and its plumbing: urllib handlers that go through the :class:`holdup.dns.Resolver` and keep
+connections alive in a :class:`holdup.net.ConnectionPool`, and a minimal asyncio HTTP/1.1 client, just enough to probe a service
+(it sends a ``GET`` or ``HEAD``, follows redirects and only reads the status line and headers).
+"""
+
+import argparse
+import re
+import socket
+import urllib.request
+from contextlib import closing
+from functools import partial
+from http.client import HTTPConnection
+from http.client import HTTPResponse
+from http.client import HTTPSConnection
+from urllib.error import HTTPError
+from urllib.error import URLError
+from urllib.parse import quote
+from urllib.parse import urljoin
+from urllib.parse import urlparse
+from urllib.parse import urlunparse
+from urllib.request import HTTPBasicAuthHandler
+from urllib.request import HTTPDigestAuthHandler
+from urllib.request import HTTPPasswordMgrWithDefaultRealm
+from urllib.request import Request
+from urllib.request import build_opener
+
+from . import __version__
+from . import net
+from .checks import Check
+from .net import ssl_context
+
+REDIRECT_CODES = frozenset((301, 302, 303, 307, 308))
+NO_BODY_CODES = frozenset((204, 304))
+MAX_REDIRECTIONS = 10
+
+# bodies up to this size are read out so the connection can be reused, bigger ones get the connection closed
+DRAIN_LIMIT = 64 * 1024
+
+HTTP_METHODS = ("GET", "HEAD")
+DEFAULT_STATUS_CODES = frozenset((200,))
+
+
+def http_method(value):
+    value = value.upper()
+    if value not in HTTP_METHODS:
+        raise ValueError(f'{value!r} is not one of {", ".join(map(repr, HTTP_METHODS))}')
+    return value
+
+
+def status_codes(value):
+    """
+    Parses a list of status codes and ranges, eg: ``200-299,401``.
+    """
+    codes = set()
+    for part in value.split(","):
+        low, sep, high = part.partition("-")
+        try:
+            low, high = int(low), int(high if sep else low)
+        except ValueError:
+            low = high = 0
+        if not 100 <= low <= high <= 599:
+            raise ValueError(f"{part!r} is not a status code or a range of them")
+        codes.update(range(low, high + 1))
+    return frozenset(codes)
+
+
+def format_status_codes(codes):
+    ranges = []
+    for code in sorted(codes):
+        if ranges and ranges[-1][1] == code - 1:
+            ranges[-1][1] = code
+        else:
+            ranges.append([code, code])
+    return ",".join(str(low) if low == high else f"{low}-{high}" for low, high in ranges)
+
+
+def body_pattern(value):
+    try:
+        return re.compile(value.encode())
+    except re.error as exc:
+        raise ValueError(exc) from None
+
+
+def positive_int(value):
+    value = int(value)
+    if value <= 0:
+        raise ValueError(f"{value} is not positive")
+    return value
+
+
+# per-service options (query-style, removed from the url), eg: "http://host/health?method=HEAD&status=200-299,401"
+HTTP_SETTINGS = {
+    "method": http_method,
+    "status": status_codes,
+    "match": body_pattern,
+    "max-bytes": positive_int,
+}
+
+
+class PooledResponse(HTTPResponse):
+    """
+    Gives the connection back to the pool once closed, if the body was read entirely (small bodies are read out).
+    """
+
+    release = None
+
+    def close(self):
+        release, self.release = self.release, None
+        if release is not None:
+            if not self.closed and not self.will_close and self.length is not None and self.length <= DRAIN_LIMIT:
+                try:
+                    self.read()
+                except OSError:
+                    pass
+            reusable = not self.will_close and self.fp is None
+            super().close()
+            release(reusable=reusable)
+        else:
+            super().close()
+
+
+class KeepAliveHandlerMixin:
+    """
+    Like ``AbstractHTTPHandler.do_open`` but without ``Connection: close`` and with pooled connections.
+    """
+
+    def keep_alive_open(self, req, key, connection_factory):
+        host = req.host
+        if not host:
+            raise URLError("no host given")
+        key = (*key, host, req._tunnel_host)
+
+        headers = dict(req.unredirected_hdrs)
+        headers.update({k: v for k, v in req.headers.items() if k not in headers})
+        headers = {name.title(): val for name, val in headers.items()}
+        tunnel_headers = {}
+        if "Proxy-Authorization" in headers:
+            tunnel_headers["Proxy-Authorization"] = headers.pop("Proxy-Authorization")
+
+        conn = self.pool.acquire(key)
+        if conn is not None:
+            conn.timeout = req.timeout
+            if conn.sock is not None:
+                conn.sock.settimeout(req.timeout)
+            try:
+                return self.keep_alive_request(req, key, conn, headers)
+            except ConnectionError:
+                pass  # the server closed the idle connection, try again with a new one
+
+        conn = connection_factory(host, timeout=req.timeout)
+        conn.response_class = PooledResponse
+        if req._tunnel_host:
+            conn.set_tunnel(req._tunnel_host, headers=tunnel_headers)
+        try:
+            return self.keep_alive_request(req, key, conn, headers)
+        except ConnectionError as exc:
+            raise URLError(exc) from None
+
+    def keep_alive_request(self, req, key, conn, headers):
+        try:
+            try:
+                conn.request(req.get_method(), req.selector, req.data, headers, encode_chunked=req.has_header("Transfer-encoding"))
+            except ConnectionError:
+                raise
+            except OSError as err:  # timeout error
+                raise URLError(err) from None
+            response = conn.getresponse()
+        except BaseException:
+            conn.close()
+            raise
+        response.release = partial(self.pool.release, key, conn)
+        response.url = req.get_full_url()
+        response.msg = response.reason
+        return response
+
+
+class RedirectHandler(urllib.request.HTTPRedirectHandler):
+    """
+    Doesn't follow the redirects with an accepted status code, urllib raises them as :class:`urllib.error.HTTPError`.
+    A ``HEAD`` request stays one after a redirect (urllib always follows with a ``GET``).
+    """
+
+    def __init__(self, status_codes):
+        self.status_codes = status_codes
+
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        if code in self.status_codes:
+            return None
+        new_req = super().redirect_request(req, fp, code, msg, headers, newurl)
+        if new_req is not None:
+            new_req.method = req.get_method()
+        return new_req
+
+
+class HTTPHandler(KeepAliveHandlerMixin, urllib.request.HTTPHandler):
+    def __init__(self, resolver, pool):
+        super().__init__()
+        self.resolver = resolver
+        self.pool = pool
+
+    def connection(self, host, **kwargs):
+        conn = HTTPConnection(host, **kwargs)
+        conn._create_connection = self.resolver.create_connection
+        return conn
+
+    def http_open(self, req):
+        return self.keep_alive_open(req, ("http",), self.connection)
+
+
+class SessionReusingHTTPSConnection(HTTPSConnection):
+    """
+    Resumes the TLS session of the previous connection to the same server (if any) to avoid full handshakes.
+    """
+
+    def __init__(self, host, *, sessions, **kwargs):
+        super().__init__(host, **kwargs)
+        self.sessions = sessions
+
+    @property
+    def server_hostname(self):
+        return self._tunnel_host or self.host
+
+    def connect(self):
+        HTTPConnection.connect(self)
+        key = self.server_hostname, self.port
+        self.sock = self._context.wrap_socket(self.sock, server_hostname=self.server_hostname, session=self.sessions.get(key))
+
+    def remember_session(self):
+        session = getattr(self.sock, "session", None)  # sock is a plain socket if the TLS handshake failed
+        if session is not None:
+            self.sessions[self.server_hostname, self.port] = session
+
+    def getresponse(self):
+        # with TLS 1.3 the session ticket only arrives after the handshake, it's surely there once we have a response
+        response = super().getresponse()
+        self.remember_session()
+        return response
+
+    def close(self):
+        # getresponse closes the connection if the server doesn't do keep-alive
+        self.remember_session()
+        super().close()
+
+
+class HTTPSHandler(KeepAliveHandlerMixin, urllib.request.HTTPSHandler):
+    def __init__(self, resolver, pool, context):
+        super().__init__(context=context)
+        self.resolver = resolver
+        self.pool = pool
+        self.sessions = {}
+
+    def connection(self, host, **kwargs):
+        conn = SessionReusingHTTPSConnection(host, sessions=self.sessions, context=self._context, **kwargs)
+        conn._create_connection = self.resolver.create_connection
+        return conn
+
+    def https_open(self, req):
+        return self.keep_alive_open(req, ("https", id(self._context)), self.connection)
+
+
+class Response:
+    def __init__(self, url, status, reason, headers):
+        self.url = url
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+
+    def __repr__(self):
+        return f"Response({self.url!r}, status={self.status!r}, reason={self.reason!r})"
+
+
+class StreamConnection:
+    """
+    A keep-alive connection for the asyncio client.
+    """
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+
+    def close(self):
+        self.writer.close()
+
+    async def request(self, url, method, path, host, headers):
+        """
+        Returns:
+            tuple: The :class:`Response` and whether the connection can be reused.
+        """
+        lines = [f"{method} {path} HTTP/1.1", f"Host: {host}"]
+        lines.extend(f"{name}: {value}" for name, value in headers.items())
+        self.writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1"))
+        await self.writer.drain()
+
+        status_line = (await self.reader.readline()).decode("latin-1").rstrip("\r\n")
+        if not status_line and self.reader.at_eof():
+            raise ConnectionResetError("Remote end closed connection without response")
+        version, _, rest = status_line.partition(" ")
+        status, _, reason = rest.partition(" ")
+        if not version.startswith("HTTP/") or not status.isdigit():
+            raise ValueError(f"Invalid HTTP status line: {status_line!r}")
+
+        response_headers = {}
+        while True:
+            line = (await self.reader.readline()).decode("latin-1").rstrip("\r\n")
+            if not line:
+                break
+            name, _, value = line.partition(":")
+            response_headers[name.strip().lower()] = value.strip()
+
+        reusable = version == "HTTP/1.1" and response_headers.get("connection", "").lower() != "close"
+        if method == "HEAD" or int(status) in NO_BODY_CODES:
+            length = "0"
+        else:
+            length = response_headers.get("content-length", "")
+        if reusable and length.isdigit() and int(length) <= DRAIN_LIMIT:
+            await self.reader.readexactly(int(length))
+        else:
+            reusable = False
+        return Response(url, int(status), reason, response_headers), reusable
+
+
+async def fetch(url, *, headers, ssl_context, resolver, pool, method="GET", status_codes=DEFAULT_STATUS_CODES):
+    """
+    Fetch the given url and return the :class:`Response` (without body) of the last hop.
+
+    Raises :class:`urllib.error.HTTPError` for 4xx and 5xx responses (just like urllib would) unless their status code is
+    in ``status_codes``. Redirects with a status code in ``status_codes`` aren't followed.
+    """
+    visited = set()
+    while True:
+        response = await request(url, method=method, headers=headers, ssl_context=ssl_context, resolver=resolver, pool=pool)
+        if response.status in status_codes:
+            return response
+        elif response.status in REDIRECT_CODES and "location" in response.headers:
+            visited.add(url)
+            url = urljoin(url, response.headers["location"])
+            if url in visited or len(visited) >= MAX_REDIRECTIONS:
+                raise HTTPError(
+                    response.url,
+                    response.status,
+                    "The HTTP server returned a redirect error that would lead to an infinite loop.\n"
+                    f"The last 30x error message was:\n{response.reason}",
+                    response.headers,
+                    None,
+                )
+        elif response.status >= 400:
+            raise HTTPError(response.url, response.status, response.reason, response.headers, None)
+        else:
+            return response
+
+
+async def request(url, *, method, headers, ssl_context, resolver, pool):
+    import asyncio
+
+    parsed_url = urlparse(url)
+    if parsed_url.scheme == "https":
+        port = parsed_url.port or 443
+        ssl = ssl_context
+    elif parsed_url.scheme == "http":
+        port = parsed_url.port or 80
+        ssl = None
+    else:
+        raise ValueError(f"Unsupported scheme in {url!r}")
+    path = parsed_url.path or "/"
+    if parsed_url.query:
+        path = f"{path}?{parsed_url.query}"
+    host = parsed_url.hostname
+    key = "async", parsed_url.scheme, id(ssl), host, port
+
+    connection = pool.acquire(key)
+    if connection is not None:
+        try:
+            response, reusable = await send(connection, url, method, path, host, headers)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass  # the server closed the idle connection, try again with a new one
+        else:
+            pool.release(key, connection, reusable)
+            return response
+
+    sock = await net.aconnect(await resolver.agetaddrinfo(host, port, 0, socket.SOCK_STREAM))
+    try:
+        reader, writer = await asyncio.open_connection(sock=sock, ssl=ssl, server_hostname=host if ssl else None)
+    except BaseException:
+        sock.close()
+        raise
+    connection = StreamConnection(reader, writer)
+    response, reusable = await send(connection, url, method, path, host, headers)
+    pool.release(key, connection, reusable)
+    return response
+
+
+async def send(connection, url, method, path, host, headers):
+    try:
+        return await connection.request(url, method, path, host, headers)
+    except BaseException:
+        connection.close()
+        raise
+
+
+class HttpCheck(Check):
+    """
+    A ``GET`` (or ``HEAD``) that passes if the status code is one of ``status`` (200 by default). Redirects are followed,
+    unless their status code is accepted.
+
+    With ``match`` the body is searched for that regular expression, only the first ``max-bytes`` of it are read. Without
+    it the body isn't read at all (bodies smaller than 64KiB are drained to keep the connection alive).
+    """
+
+    def __init__(self, url, *, method="GET", status=DEFAULT_STATUS_CODES, match=None, max_bytes=DRAIN_LIMIT):
+        if match and method == "HEAD":
+            raise argparse.ArgumentTypeError(f"Invalid service spec {url!r}. The match option needs a body, it can't be used with HEAD.")
+        self.method = method
+        self.status_codes = status
+        self.match = match
+        self.max_bytes = max_bytes
+        self.handlers = []
+        self.openers = {}
+        self.parsed_url = url = urlparse(url)
+        self.scheme = url.scheme
+        self.insecure = False
+        if url.scheme == "https+insecure":
+            self.insecure = True
+            url = url._replace(scheme="https")
+
+        if url.port:
+            self.netloc = f"{url.hostname}:{url.port}"
+        else:
+            self.netloc = url.hostname
+        self.host = url.hostname
+
+        cleaned_url = urlunparse(url._replace(netloc=self.netloc))
+
+        if url.username or url.password:
+            password_mgr = HTTPPasswordMgrWithDefaultRealm()
+            password_mgr.add_password(None, cleaned_url, url.username, url.password)
+            self.handlers.append(HTTPDigestAuthHandler(passwd=password_mgr))
+            self.handlers.append(HTTPBasicAuthHandler(password_mgr=password_mgr))
+
+        self.url = cleaned_url
+
+    def ssl_context(self, options):
+        return ssl_context(self.insecure or options.insecure)
+
+    def opener(self, options):
+        insecure = self.insecure or options.insecure
+        opener = self.openers.get(insecure)
+        if opener is None:
+            handlers = list(self.handlers)
+            handlers.append(HTTPHandler(options.resolver, options.http_pool))
+            handlers.append(HTTPSHandler(options.resolver, options.http_pool, self.ssl_context(options)))
+            handlers.append(RedirectHandler(self.status_codes))
+            opener = self.openers[insecure] = build_opener(*handlers)
+            opener.addheaders = [("User-Agent", f"python-holdup/{__version__}")]
+        return opener
+
+    def run(self, options):
+        request = Request(self.url, headers={"Host": self.host}, method=self.method)  # noqa: S310
+        try:
+            response = self.opener(options).open(request, timeout=options.check_timeout)
+        except HTTPError as exc:
+            if exc.code not in self.status_codes:
+                exc.close()  # so the connection goes back in the pool
+                raise
+            response = exc
+        with closing(response):
+            self.check_status(response.getcode())
+            if self.match:
+                self.check_body(response.read(self.max_bytes))
+
+    async def arun(self, options):
+        if self.handlers or self.match:
+            # authentication (digest especially) and reading bodies are left to urllib
+            return await super().arun(options)
+        import asyncio
+
+        response = await asyncio.wait_for(
+            fetch(
+                self.url,
+                headers={"User-Agent": f"python-holdup/{__version__}"},
+                ssl_context=self.ssl_context(options),
+                resolver=options.resolver,
+                pool=options.http_pool,
+                method=self.method,
+                status_codes=self.status_codes,
+            ),
+            options.check_timeout,
+        )
+        self.check_status(response.status)
+
+    def check_status(self, status):
+        if status not in self.status_codes:
+            raise Exception(f"Expected status code {format_status_codes(self.status_codes)}, got {status!r}")
+
+    def check_body(self, body):
+        if not self.match.search(body):
+            pattern = self.match.pattern.decode()
+            raise Exception(f"No match for {pattern!r} in the first {self.max_bytes} bytes of the body")
+
+    def __repr__(self):
+        return f"HttpCheck({self.url}, insecure={self.insecure}, status={self.status})"
+
+    def display_definition(self, *, verbose_passwords):
+        url = self.parsed_url
+        if url.username and not verbose_passwords:
+            if not url.password:
+                mask = "******"
+            else:
+                mask = f"{url.username}:******"
+            url = url._replace(netloc=f"{mask}@{self.netloc}")
+        definition = urlunparse(url)
+        settings = self.display_settings()
+        if settings:
+            definition += f"{'&' if url.query else '?'}{settings}"
+        return definition
+
+    def display_settings(self):
+        """
+        Returns:
+            str: The options that differ from the defaults, query-style (they change what passes, thus they have to be
+                part of the definition, eg: for the ``--cache-dir`` entries).
+        """
+        settings = []
+        if self.method != "GET":
+            settings.append(f"method={self.method}")
+        if self.status_codes != DEFAULT_STATUS_CODES:
+            settings.append(f"status={format_status_codes(self.status_codes)}")
+        if self.match:
+            settings.append(f"match={quote(self.match.pattern.decode(), safe='')}")
+        if self.max_bytes != DRAIN_LIMIT:
+            settings.append(f"max-bytes={self.max_bytes}")
+        return "&".join(settings)
@@ -0,0 +1,146 @@
+"""
+Filesystem change notifications through Linux's inotify (via ctypes), so checks waiting for a path to appear or change
+can be retried as soon as something happens instead of every ``--interval``.
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import selectors
+import struct
+import sys
+import threading
+from pathlib import Path
+
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+EVENT = struct.Struct("iIII")
+
+
+def load_libc():
+    """
+    Returns:
+        ctypes.CDLL: The C library, if it has inotify, otherwise ``None``.
+    """
+    if not sys.platform.startswith("linux"):
+        return
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        libc.inotify_init1.argtypes = [ctypes.c_int]
+        libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+    except (OSError, AttributeError):
+        return
+    return libc
+
+
+class Watcher:
+    """
+    Calls ``callback(key)`` (from a background thread) when the path given to :meth:`watch` for that key changes. Every
+    :meth:`watch` call fires at most once.
+
+    Raises:
+        OSError: If inotify is not available.
+    """
+
+    def __init__(self, callback):
+        self.libc = load_libc()
+        if self.libc is None:
+            raise OSError(errno.ENOSYS, "inotify is not available")
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+        self.callback = callback
+        self.watches = {}  # watch descriptor -> {key: name of the entry waited for}
+        self.lock = threading.Lock()
+        self.wakeup_reader, self.wakeup_writer = os.pipe()
+        self.thread = threading.Thread(target=self.run, name="holdup-inotify", daemon=True)
+        self.thread.start()
+
+    def watch(self, key, path, *, missing):
+        """
+        Watches the nearest existing directory above ``path``. If ``missing`` (the check failed because ``path`` doesn't
+        exist) and it exists by now the callback is called right away.
+
+        Returns:
+            bool: ``False`` if the path can't be watched.
+        """
+        path = Path(path).absolute()
+        directory, name = path.parent, path.name
+        while not directory.is_dir():
+            if directory == directory.parent:
+                return False
+            directory, name = directory.parent, directory.name
+        with self.lock:
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(directory), WATCH_MASK)
+            if wd < 0:
+                return False
+            self.watches.setdefault(wd, {})[key] = name
+        if missing and os.path.lexists(directory / name):
+            self.fire(wd, {name})
+        return True
+
+    def fire(self, wd, names):
+        """
+        Calls back the keys waiting on any of the given names (all of them, if ``names`` is ``None``).
+        """
+        with self.lock:
+            keys = self.watches.get(wd, {})
+            fired = [key for key, name in keys.items() if names is None or name in names]
+            for key in fired:
+                del keys[key]
+            if not keys and wd in self.watches:
+                del self.watches[wd]
+                self.libc.inotify_rm_watch(self.fd, wd)
+        for key in fired:
+            self.callback(key)
+
+    def run(self):
+        selector = selectors.DefaultSelector()
+        selector.register(self.fd, selectors.EVENT_READ)
+        selector.register(self.wakeup_reader, selectors.EVENT_READ)
+        try:
+            while True:
+                ready = {key.fd for key, _ in selector.select()}
+                if self.wakeup_reader in ready:
+                    return
+                try:
+                    data = os.read(self.fd, 64 * 1024)
+                except BlockingIOError:
+                    continue
+                events = {}
+                offset = 0
+                while offset < len(data):
+                    wd, mask, _, length = EVENT.unpack_from(data, offset)
+                    name = data[offset + EVENT.size : offset + EVENT.size + length].rstrip(b"\0")
+                    offset += EVENT.size + length
+                    if mask & IN_Q_OVERFLOW:
+                        for wd in list(self.watches):
+                            events[wd] = None
+                    elif mask & (IN_DELETE_SELF | IN_MOVE_SELF | IN_IGNORED):
+                        events[wd] = None
+                    elif events.get(wd, ()) is not None:
+                        events.setdefault(wd, set()).add(os.fsdecode(name))
+                for wd, names in events.items():
+                    self.fire(wd, names)
+        finally:
+            selector.close()
+            os.close(self.wakeup_reader)
+            os.close(self.fd)
+
+    def close(self):
+        os.write(self.wakeup_writer, b"\0")
+        os.close(self.wakeup_writer)
+        self.thread.join()
@@ -0,0 +1,95 @@
+"""
+Prometheus metrics about the checks, served while waiting (``--metrics-port``). Only imported when enabled.
+"""
+
+import threading
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from time import time
+
+from .report import histogram
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def escape(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def render(report, checks):
+    """
+    Returns:
+        str: The metrics in the Prometheus text exposition format.
+    """
+    services = [(check, escape(check.display(verbose=False, verbose_passwords=False))) for check in checks]
+    attempts = {check: list(report.attempts.get(check, ())) for check in checks}
+    lines = [
+        "# HELP holdup_elapsed_seconds Time since holdup started waiting.",
+        "# TYPE holdup_elapsed_seconds gauge",
+        f"holdup_elapsed_seconds {time() - report.start}",
+        "# HELP holdup_pending_checks Checks that did not pass yet.",
+        "# TYPE holdup_pending_checks gauge",
+        f"holdup_pending_checks {sum(check.error is not False for check in checks)}",
+        "# HELP holdup_check_passed Whether the check passed.",
+        "# TYPE holdup_check_passed gauge",
+    ]
+    lines.extend(f'holdup_check_passed{{service="{service}"}} {int(check.error is False)}' for check, service in services)
+    lines += [
+        "# HELP holdup_check_attempts_total Attempts made for the check.",
+        "# TYPE holdup_check_attempts_total counter",
+    ]
+    lines.extend(f'holdup_check_attempts_total{{service="{service}"}} {len(attempts[check])}' for check, service in services)
+    lines += [
+        "# HELP holdup_check_failures_total Failed attempts, by error class.",
+        "# TYPE holdup_check_failures_total counter",
+    ]
+    for check, service in services:
+        errors = {}
+        for _, _, error in attempts[check]:
+            if error:
+                errors[error] = errors.get(error, 0) + 1
+        lines.extend(f'holdup_check_failures_total{{service="{service}",error="{error}"}} {count}' for error, count in errors.items())
+    lines += [
+        "# HELP holdup_check_latency_seconds How long the attempts took.",
+        "# TYPE holdup_check_latency_seconds histogram",
+    ]
+    for check, service in services:
+        latencies = [latency for _, latency, _ in attempts[check]]
+        for bound, count in histogram(latencies).items():
+            lines.append(f'holdup_check_latency_seconds_bucket{{service="{service}",le="{bound}"}} {count}')
+        lines.append(f'holdup_check_latency_seconds_sum{{service="{service}"}} {sum(latencies)}')
+        lines.append(f'holdup_check_latency_seconds_count{{service="{service}"}} {len(latencies)}')
+    lines.append("")
+    return "\n".join(lines)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?", 1)[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = render(self.server.report, self.server.checks).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class MetricsServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, port, report, checks):
+        super().__init__(("", port), MetricsHandler)
+        self.report = report
+        self.checks = checks
+        self.thread = threading.Thread(target=self.serve_forever, name="holdup-metrics", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        self.thread.join()
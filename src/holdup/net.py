@@ -0,0 +1,213 @@
+"""
+Happy Eyeballs (`RFC 8305 <https://datatracker.ietf.org/doc/html/rfc8305>`_) connection racing: connection attempts are
+made to all the addresses a name resolves to (IPv6 and IPv4 interleaved), a new attempt is started every
+:data:`CONNECTION_ATTEMPT_DELAY` seconds (or as soon as the previous one failed) and the first one that connects wins.
+"""
+
+import errno
+import os
+import selectors
+import socket
+import threading
+from functools import lru_cache
+from itertools import zip_longest
+from time import time
+
+CONNECTION_ATTEMPT_DELAY = 0.25
+
+
+def interleave(addresses):
+    """
+    Reorders ``getaddrinfo`` results so families alternate, starting with the family of the first address.
+    """
+    families = {}
+    for address in addresses:
+        families.setdefault(address[0], []).append(address)
+    return [address for group in zip_longest(*families.values()) for address in group if address is not None]
+
+
+def connect(addresses, timeout=None, source_address=None, delay=CONNECTION_ATTEMPT_DELAY):
+    """
+    Returns:
+        socket.socket: The first socket that connected (with the given timeout set on it).
+    """
+    addresses = interleave(addresses)
+    deadline = None if timeout is None else time() + timeout
+    selector = selectors.DefaultSelector()
+    error = None
+    next_attempt = 0
+    try:
+        while addresses or selector.get_map():
+            now = time()
+            if addresses and (not selector.get_map() or now >= next_attempt):
+                family, socktype, proto, _, sockaddr = addresses.pop(0)
+                sock = socket.socket(family, socktype, proto)
+                try:
+                    sock.setblocking(False)
+                    if source_address:
+                        sock.bind(source_address)
+                    code = sock.connect_ex(sockaddr)
+                except OSError as exc:
+                    code = exc.errno
+                if code in (errno.EINPROGRESS, errno.EWOULDBLOCK):
+                    selector.register(sock, selectors.EVENT_WRITE)
+                    next_attempt = now + delay
+                elif code:
+                    error = OSError(code, os.strerror(code))
+                    sock.close()
+                    continue
+                else:
+                    sock.settimeout(timeout)
+                    return sock
+            if deadline is not None and now >= deadline:
+                raise socket.timeout("timed out")
+            wait = None if deadline is None else deadline - now
+            if addresses:
+                wait = next_attempt - now if wait is None else min(wait, next_attempt - now)
+            for key, _ in selector.select(wait):
+                sock = key.fileobj
+                selector.unregister(sock)
+                code = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                if code:
+                    error = OSError(code, os.strerror(code))
+                    sock.close()
+                else:
+                    sock.settimeout(timeout)
+                    return sock
+        raise error
+    finally:
+        for key in list(selector.get_map().values()):
+            key.fileobj.close()
+        selector.close()
+
+
+async def aconnect(addresses, delay=CONNECTION_ATTEMPT_DELAY):
+    """
+    Asynchronous variant of :func:`connect`. Use :func:`asyncio.wait_for` for timeouts.
+
+    Returns:
+        socket.socket: The first socket that connected (in non-blocking mode).
+    """
+    import asyncio
+
+    loop = asyncio.get_running_loop()
+    addresses = interleave(addresses)
+    attempts = {}
+    error = None
+    try:
+        while addresses or attempts:
+            if addresses:
+                family, socktype, proto, _, sockaddr = addresses.pop(0)
+                sock = socket.socket(family, socktype, proto)
+                sock.setblocking(False)
+                attempts[asyncio.ensure_future(loop.sock_connect(sock, sockaddr))] = sock
+            done, _ = await asyncio.wait(attempts, timeout=delay if addresses else None, return_when=asyncio.FIRST_COMPLETED)
+            for attempt in done:
+                sock = attempts.pop(attempt)
+                if attempt.exception():
+                    error = attempt.exception()
+                    sock.close()
+                else:
+                    return sock
+        raise error
+    finally:
+        for attempt in attempts:
+            attempt.cancel()
+        await asyncio.gather(*attempts, return_exceptions=True)
+        for sock in attempts.values():
+            sock.close()
+
+
+def converse(sock, steps, header_size, parse_header):
+    """
+    Runs a client written without the I/O over a blocking socket. ``steps`` is a generator that yields what to send
+    (possibly nothing) before getting sent the next message received and returns what to send before closing.
+
+    Messages start with a header of ``header_size`` bytes, ``parse_header`` turns it into the length of the payload
+    followed by the other fields of the message. The generator gets these fields and the payload as a tuple.
+    """
+    with sock.makefile("rb") as reader:
+        data = next(steps)
+        while True:
+            sock.sendall(data)
+            header = reader.read(header_size)
+            if len(header) < header_size:
+                raise ConnectionResetError("Server closed the connection")
+            length, *fields = parse_header(header)
+            payload = reader.read(length)
+            if len(payload) < length:
+                raise ConnectionResetError("Server closed the connection")
+            try:
+                data = steps.send((*fields, payload))
+            except StopIteration as stop:
+                sock.sendall(stop.value)
+                return
+
+
+async def aconverse(reader, writer, steps, header_size, parse_header):
+    """
+    Asynchronous variant of :func:`converse`, over a pair of asyncio streams.
+    """
+    data = next(steps)
+    while True:
+        writer.write(data)
+        length, *fields = parse_header(await reader.readexactly(header_size))
+        try:
+            data = steps.send((*fields, await reader.readexactly(length)))
+        except StopIteration as stop:
+            writer.write(stop.value)
+            return
+
+
+@lru_cache(maxsize=None)
+def ssl_context(insecure, alpn_protocols=()):
+    """
+    Creating a context loads the CA bundle from disk so only a few are ever made: a verifying one and an insecure one (for
+    each set of ALPN protocols).
+    """
+    import ssl
+
+    context = ssl.create_default_context()
+    if insecure:
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+    if alpn_protocols:
+        context.set_alpn_protocols(alpn_protocols)
+    return context
+
+
+class ConnectionPool:
+    """
+    Idle keep-alive connections, shared by all the http checks. Anything with a ``close`` method can be pooled.
+    """
+
+    def __init__(self, max_idle=4):
+        self.max_idle = max_idle
+        self.idle = {}
+        self.lock = threading.Lock()
+
+    def acquire(self, key):
+        """
+        Returns:
+            An idle connection or ``None``.
+        """
+        with self.lock:
+            connections = self.idle.get(key)
+            if connections:
+                return connections.pop()
+
+    def release(self, key, connection, reusable=True):
+        if reusable:
+            with self.lock:
+                connections = self.idle.setdefault(key, [])
+                if len(connections) < self.max_idle:
+                    connections.append(connection)
+                    return
+        connection.close()
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, {}
+        for connections in idle.values():
+            for connection in connections:
+                connection.close()
@@ -1,3 +1,12 @@
+import os
+import re
+import selectors
+import socket
+from contextlib import closing
+from time import time
+
+from .checks import Check
+
 try:
     import psycopg
 except ImportError:
@@ -16,3 +25,256 @@ except ImportError:
         from psycopg2.extensions import make_dsn as make_conninfo
     except ImportError:
         make_conninfo = lambda value: value  # noqa
+
+try:
+    from psycopg.conninfo import conninfo_to_dict
+except ImportError:
+    try:
+        from psycopg2.extensions import parse_dsn as conninfo_to_dict
+    except ImportError:
+        conninfo_to_dict = None
+
+
+async def resolve_hostaddr(connection_string, resolver):
+    """
+    Resolves the hosts of the connection string through the resolver and adds them as ``hostaddr`` (like psycopg's
+    ``resolve_hostaddr_async``), otherwise libpq would block the event loop in ``getaddrinfo``.
+
+    Returns:
+        str: The connection string to connect with.
+    """
+    if conninfo_to_dict is None:
+        return connection_string
+    params = conninfo_to_dict(connection_string)
+    hosts = params.get("host", os.environ.get("PGHOST", ""))
+    if not hosts or "hostaddr" in params or "PGHOSTADDR" in os.environ:
+        return connection_string
+    hosts = hosts.split(",")
+    ports = str(params.get("port", os.environ.get("PGPORT", ""))).split(",")
+    if len(ports) == 1:
+        ports *= len(hosts)
+    if len(ports) != len(hosts):
+        return connection_string  # libpq reports the mismatch
+    resolved_hosts, resolved_addrs, resolved_ports = [], [], []
+    error = None
+    for host, port in zip(hosts, ports):
+        if not host or host.startswith("/") or host[1:2] == ":":  # unix socket directory
+            addrs = [""]
+        else:
+            try:
+                addresses = await resolver.agetaddrinfo(host, int(port or 5432), 0, socket.SOCK_STREAM)
+            except OSError as exc:
+                error = exc  # libpq tries the other hosts
+                continue
+            addrs = [sockaddr[0] for *_, sockaddr in addresses]
+        resolved_hosts += [host] * len(addrs)
+        resolved_addrs += addrs
+        resolved_ports += [port] * len(addrs)
+    if not resolved_hosts:
+        raise error
+    params.update(host=",".join(resolved_hosts), hostaddr=",".join(resolved_addrs))
+    if any(resolved_ports):
+        params["port"] = ",".join(resolved_ports)
+    return make_conninfo(**params)
+
+
+def connect_pq(connection_string):
+    """
+    Connects through psycopg 3's libpq wrapper, without blocking.
+
+    Yields:
+        tuple: A file descriptor and the event (``selectors.EVENT_READ`` or ``EVENT_WRITE``) to wait for before resuming.
+
+    Returns:
+        PqConnection: The connection.
+    """
+    pq = psycopg.pq
+    pgconn = pq.PGconn.connect_start(connection_string.encode())
+    try:
+        while True:
+            if pgconn.status == pq.ConnStatus.BAD:
+                raise psycopg.OperationalError(error_message(pgconn))
+            status = pgconn.connect_poll()
+            if status == pq.PollingStatus.OK:
+                break
+            elif status == pq.PollingStatus.READING:
+                yield pgconn.socket, selectors.EVENT_READ
+            elif status == pq.PollingStatus.WRITING:
+                yield pgconn.socket, selectors.EVENT_WRITE
+            else:
+                raise psycopg.OperationalError(error_message(pgconn))
+        pgconn.nonblocking = 1
+    except BaseException:
+        pgconn.finish()
+        raise
+    return PqConnection(pgconn)
+
+
+def query_pq(connection, query):
+    """
+    Runs a query on a connection made by :func:`connect_pq` (same yields).
+    """
+    pq = psycopg.pq
+    pgconn = connection.pgconn
+    pgconn.send_query(query.encode())
+    while pgconn.flush():
+        yield pgconn.socket, selectors.EVENT_WRITE
+    results = []
+    while True:
+        pgconn.consume_input()
+        if pgconn.is_busy():  # get_result would block
+            yield pgconn.socket, selectors.EVENT_READ
+        else:
+            result = pgconn.get_result()
+            if result is None:
+                break
+            results.append(result)
+    result = results[0]
+    if result.status != pq.ExecStatus.TUPLES_OK:
+        raise psycopg.OperationalError(result.error_message.decode(errors="replace").strip())
+
+
+def error_message(pgconn):
+    return pgconn.error_message.decode(errors="replace").strip()
+
+
+class PqConnection:
+    """
+    A libpq connection that can be kept in a :class:`holdup.net.ConnectionPool`.
+    """
+
+    def __init__(self, pgconn):
+        self.pgconn = pgconn
+
+    def close(self):
+        self.pgconn.finish()
+
+
+def connect_dbapi(connection_string):
+    """
+    Same as :func:`connect_pq` but for psycopg2 (and psycopg2cffi), through their asynchronous connections.
+    """
+    conn = psycopg.connect(connection_string, async_=True)
+    try:
+        yield from poll(conn)
+    except BaseException:
+        conn.close()
+        raise
+    return conn
+
+
+def query_dbapi(conn, query):
+    cursor = conn.cursor()
+    cursor.execute(query)
+    yield from poll(conn)
+    cursor.fetchone()
+
+
+def poll(conn):
+    extensions = psycopg.extensions
+    while True:
+        state = conn.poll()
+        if state == extensions.POLL_OK:
+            return
+        elif state == extensions.POLL_READ:
+            yield conn.fileno(), selectors.EVENT_READ
+        elif state == extensions.POLL_WRITE:
+            yield conn.fileno(), selectors.EVENT_WRITE
+        else:
+            raise psycopg.OperationalError(f"Bad poll state: {state!r}")
+
+
+def set_ready(ready):
+    if not ready.done():
+        ready.set_result(None)
+
+
+class PgCheck(Check):
+    """
+    Connects and runs a query without blocking (libpq's ``PQconnectPoll``), thus timeouts are precise and the check
+    doesn't need a thread with the async engine.
+
+    With ``--reuse-pg-connections`` the connection is kept after a successful check and the next check only runs
+    ``SELECT 1`` on it (a single round trip instead of connecting, TLS and authentication). A kept connection that
+    fails is replaced by a new one right away.
+    """
+
+    def __init__(self, connection_string):
+        self.connection_string = connection_string
+
+    def probe(self, pool, connection_string=None):
+        """
+        Connects with ``connection_string`` (the check's by default), the pool is keyed by the check's.
+        """
+        if hasattr(psycopg, "pq"):
+            connect, query = connect_pq, query_pq
+        else:
+            connect, query = connect_dbapi, query_dbapi
+        connection = pool.acquire(self.connection_string) if pool else None
+        if connection is not None:
+            try:
+                yield from query(connection, "SELECT 1")
+            except psycopg.Error:
+                connection.close()  # went stale while idle
+            except BaseException:
+                connection.close()
+                raise
+            else:
+                pool.release(self.connection_string, connection)
+                return
+        connection = yield from connect(connection_string or self.connection_string)
+        try:
+            yield from query(connection, "SELECT version()")
+        except BaseException:
+            connection.close()
+            raise
+        if pool:
+            pool.release(self.connection_string, connection)
+        else:
+            connection.close()
+
+    def run(self, options):
+        deadline = time() + options.check_timeout
+        with closing(self.probe(options.pg_pool)) as steps, selectors.DefaultSelector() as selector:
+            for fileno, event in steps:
+                remaining = deadline - time()
+                if remaining <= 0:
+                    raise socket.timeout("timed out")
+                selector.register(fileno, event)
+                try:
+                    if not selector.select(remaining):
+                        raise socket.timeout("timed out")
+                finally:
+                    selector.unregister(fileno)
+
+    async def arun(self, options):
+        import asyncio
+
+        await asyncio.wait_for(self.aprobe(options), options.check_timeout)
+
+    async def aprobe(self, options):
+        import asyncio
+
+        loop = asyncio.get_running_loop()
+        connection_string = await resolve_hostaddr(self.connection_string, options.resolver)
+        with closing(self.probe(options.pg_pool, connection_string)) as steps:
+            for fileno, event in steps:
+                ready = loop.create_future()
+                if event == selectors.EVENT_READ:
+                    add, remove = loop.add_reader, loop.remove_reader
+                else:
+                    add, remove = loop.add_writer, loop.remove_writer
+                add(fileno, set_ready, ready)
+                try:
+                    await ready
+                finally:
+                    remove(fileno)
+
+    def __repr__(self):
+        return f"PgCheck({self.connection_string})"
+
+    def display_definition(self, *, verbose_passwords, _password_re=re.compile(r":[^@:]+@")):
+        definition = str(self.connection_string)
+        if not verbose_passwords:
+            definition = _password_re.sub(":******@", definition, 1)
+        return definition
@@ -0,0 +1,254 @@
+"""
+The :class:`PgWireCheck`: a PostgreSQL probe that speaks just enough of the wire protocol (v3) over a plain socket, thus
+it doesn't need libpq or psycopg.
+
+Without a password it answers the question ``pg_isready`` answers: the server is up if it responds to the startup
+message with anything but a "cannot connect now" error (starting up, shutting down or in recovery), typically an
+authentication request. With a password (empty is fine for ``trust`` authentication) it logs in (cleartext, MD5 or
+SCRAM-SHA-256) and runs ``SELECT 1``.
+"""
+
+import argparse
+import base64
+import hashlib
+import hmac
+import os
+import re
+import socket
+import struct
+from contextlib import closing
+from urllib.parse import parse_qsl
+from urllib.parse import unquote
+from urllib.parse import urlparse
+
+from . import net
+from .checks import Check
+
+DEFAULT_PORT = 5432
+DEFAULT_USER = "postgres"
+SSL_MODES = ("disable", "prefer", "require", "verify-full")
+
+PROTOCOL_VERSION = 196608  # 3.0
+SSL_REQUEST = struct.pack("!II", 8, 80877103)
+TERMINATE = b"X\0\0\0\4"
+SELECT_1 = b"Q\0\0\0\15SELECT 1\0"
+
+AUTH_OK = 0
+AUTH_CLEARTEXT_PASSWORD = 3
+AUTH_MD5_PASSWORD = 5
+AUTH_SASL = 10
+AUTH_SASL_CONTINUE = 11
+AUTH_SASL_FINAL = 12
+
+CANNOT_CONNECT_NOW = "57P03"
+
+
+class PgError(Exception):
+    """
+    An ``ErrorResponse`` from the server.
+    """
+
+    def __init__(self, payload):
+        fields = {field[:1]: field[1:].decode(errors="replace") for field in payload.split(b"\0") if field}
+        self.code = fields.get(b"C")
+        super().__init__(f"{fields.get(b'S', 'ERROR')}: {fields.get(b'M', 'unknown error')} (SQLSTATE {self.code})")
+
+
+def message(kind, payload):
+    return kind + struct.pack("!I", len(payload) + 4) + payload
+
+
+def message_header(header):
+    """
+    Returns:
+        tuple: The payload length and the kind of the message.
+    """
+    kind, length = struct.unpack("!cI", header)
+    return length - 4, kind
+
+
+def startup_message(user, database):
+    parameters = [("user", user), ("database", database), ("application_name", "holdup")]
+    payload = struct.pack("!I", PROTOCOL_VERSION) + b"".join(f"{name}\0{value}\0".encode() for name, value in parameters) + b"\0"
+    return struct.pack("!I", len(payload) + 4) + payload
+
+
+def md5_password(user, password, salt):
+    inner = hashlib.md5(password.encode() + user.encode()).hexdigest()  # noqa: S324
+    return b"md5" + hashlib.md5(inner.encode() + salt).hexdigest().encode()  # noqa: S324
+
+
+class Scram:
+    """
+    The client side of SCRAM-SHA-256 (`RFC 7677 <https://datatracker.ietf.org/doc/html/rfc7677>`_), without channel
+    binding. The user name is left out, the server uses the one from the startup message.
+    """
+
+    mechanism = b"SCRAM-SHA-256"
+
+    def __init__(self, password):
+        self.password = password.encode()
+        self.nonce = base64.b64encode(os.urandom(18)).decode()
+        self.client_first_bare = f"n=,r={self.nonce}"
+        self.server_signature = None
+
+    def initial_response(self):
+        data = f"n,,{self.client_first_bare}".encode()
+        return message(b"p", self.mechanism + b"\0" + struct.pack("!I", len(data)) + data)
+
+    def final_response(self, server_first):
+        server_first = server_first.decode()
+        attributes = dict(item.split("=", 1) for item in server_first.split(","))
+        if not attributes["r"].startswith(self.nonce):
+            raise Exception("SCRAM authentication failed: the server nonce doesn't match")
+        salted_password = hashlib.pbkdf2_hmac("sha256", self.password, base64.b64decode(attributes["s"]), int(attributes["i"]))
+        client_key = hmac.digest(salted_password, b"Client Key", "sha256")
+        client_final_without_proof = f"c=biws,r={attributes['r']}"
+        auth_message = f"{self.client_first_bare},{server_first},{client_final_without_proof}".encode()
+        client_signature = hmac.digest(hashlib.sha256(client_key).digest(), auth_message, "sha256")
+        proof = base64.b64encode(bytes(a ^ b for a, b in zip(client_key, client_signature))).decode()
+        server_key = hmac.digest(salted_password, b"Server Key", "sha256")
+        self.server_signature = base64.b64encode(hmac.digest(server_key, auth_message, "sha256")).decode()
+        return message(b"p", f"{client_final_without_proof},p={proof}".encode())
+
+    def verify(self, server_final):
+        if server_final.decode() != f"v={self.server_signature}":
+            raise Exception("SCRAM authentication failed: bad server signature")
+
+
+def conversation(user, password, database):
+    """
+    The PostgreSQL client, for :func:`holdup.net.converse` (with :func:`message_header`).
+
+    Yields:
+        bytes: What to send to the server (possibly nothing) before sending back the next message received, as a
+            ``(kind, payload)`` tuple.
+
+    Returns:
+        bytes: What to send to the server before closing the connection.
+    """
+    login = password is not None
+    kind, payload = yield startup_message(user, database)
+    scram = None
+    while kind != b"Z":  # ReadyForQuery
+        reply = b""
+        if kind == b"E":
+            error = PgError(payload)
+            if login or error.code == CANNOT_CONNECT_NOW:
+                raise error
+            return b""  # the server is up, it just doesn't like us
+        elif kind == b"R":
+            (code,) = struct.unpack_from("!I", payload)
+            if not login:
+                return b""
+            elif code == AUTH_OK:
+                pass
+            elif code == AUTH_CLEARTEXT_PASSWORD:
+                reply = message(b"p", password.encode() + b"\0")
+            elif code == AUTH_MD5_PASSWORD:
+                reply = message(b"p", md5_password(user, password, payload[4:8]) + b"\0")
+            elif code == AUTH_SASL and Scram.mechanism in payload[4:].split(b"\0"):
+                scram = Scram(password)
+                reply = scram.initial_response()
+            elif code == AUTH_SASL_CONTINUE and scram:
+                reply = scram.final_response(payload[4:])
+            elif code == AUTH_SASL_FINAL and scram:
+                scram.verify(payload[4:])
+            else:
+                raise Exception(f"Unsupported authentication method (request code {code})")
+        kind, payload = yield reply
+    kind, payload = yield SELECT_1
+    error = None
+    while kind != b"Z":
+        if kind == b"E":
+            error = PgError(payload)
+        kind, payload = yield b""
+    if error:
+        raise error
+    return TERMINATE
+
+
+class PgWireCheck(Check):
+    def __init__(self, url):
+        self.url = url
+        parsed_url = urlparse(url)
+        try:
+            self.port = parsed_url.port or DEFAULT_PORT
+        except ValueError as exc:
+            raise argparse.ArgumentTypeError(f"Invalid service spec {url!r}. {exc}.") from None
+        self.host = parsed_url.hostname
+        if not self.host:
+            raise argparse.ArgumentTypeError(f"Invalid service spec {url!r}. Must have a host.")
+        self.user = unquote(parsed_url.username or DEFAULT_USER)
+        self.password = None if parsed_url.password is None else unquote(parsed_url.password)
+        self.database = unquote(parsed_url.path.lstrip("/")) or self.user
+        parameters = dict(parse_qsl(parsed_url.query))
+        self.sslmode = parameters.pop("sslmode", "disable")
+        if self.sslmode not in SSL_MODES:
+            raise argparse.ArgumentTypeError(f"Invalid service spec {url!r}. Bad sslmode: must be one of {', '.join(SSL_MODES)}.")
+        if parameters:
+            raise argparse.ArgumentTypeError(f"Invalid service spec {url!r}. Unknown parameters: {', '.join(parameters)}.")
+
+    def ssl_context(self, options):
+        # like libpq, "require" only encrypts
+        return net.ssl_context(self.sslmode != "verify-full" or options.insecure)
+
+    def ssl_accepted(self, answer):
+        """
+        Returns:
+            bool: ``True`` if the connection has to be wrapped in TLS, after the server's answer to the ``SSLRequest``.
+        """
+        if answer == b"S":
+            return True
+        elif answer == b"N" and self.sslmode == "prefer":
+            return False
+        elif answer == b"N":
+            raise Exception(f"The server doesn't support SSL (sslmode={self.sslmode})")
+        else:
+            raise Exception(f"Unexpected response to SSLRequest: {answer!r}")
+
+    def run(self, options):
+        addresses = options.resolver.getaddrinfo(self.host, self.port, 0, socket.SOCK_STREAM)
+        sock = net.connect(addresses, options.check_timeout)
+        with closing(sock):
+            if self.sslmode != "disable":
+                sock.sendall(SSL_REQUEST)
+                if self.ssl_accepted(sock.recv(1)):
+                    sock = self.ssl_context(options).wrap_socket(sock, server_hostname=self.host)
+            with closing(sock):
+                net.converse(sock, conversation(self.user, self.password, self.database), 5, message_header)
+
+    async def arun(self, options):
+        import asyncio
+
+        await asyncio.wait_for(self.aprobe(options), options.check_timeout)
+
+    async def aprobe(self, options):
+        import asyncio
+
+        addresses = await options.resolver.agetaddrinfo(self.host, self.port, 0, socket.SOCK_STREAM)
+        sock = await net.aconnect(addresses)
+        try:
+            ssl_context = None
+            if self.sslmode != "disable":
+                loop = asyncio.get_running_loop()
+                await loop.sock_sendall(sock, SSL_REQUEST)
+                if self.ssl_accepted(await loop.sock_recv(sock, 1)):
+                    ssl_context = self.ssl_context(options)
+            reader, writer = await asyncio.open_connection(sock=sock, ssl=ssl_context, server_hostname=self.host if ssl_context else None)
+        except BaseException:
+            sock.close()
+            raise
+        try:
+            await net.aconverse(reader, writer, conversation(self.user, self.password, self.database), 5, message_header)
+        finally:
+            writer.close()
+
+    def __repr__(self):
+        return f"PgWireCheck({self.display_definition(verbose_passwords=False)}, status={self.status})"
+
+    def display_definition(self, *, verbose_passwords, _password_re=re.compile(r":[^@:/]*@")):
+        definition = self.url
+        if not verbose_passwords:
+            definition = _password_re.sub(":******@", definition, 1)
+        return definition
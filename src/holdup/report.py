@@ -0,0 +1,99 @@
+import argparse
+import json
+import sys
+from collections import defaultdict
+from pathlib import Path
+from time import time
+
+from . import __version__
+
+REPORT_FORMATS = ("json",)
+
+# upper bounds (in seconds) of the latency histogram buckets
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def report_destination(value):
+    """
+    Parses the ``--report`` option (``FORMAT[:PATH]``).
+
+    Returns:
+        tuple: The format and the path (``None`` for stdout).
+    """
+    fmt, _, path = value.partition(":")
+    if fmt not in REPORT_FORMATS:
+        raise argparse.ArgumentTypeError(f'Invalid report format {fmt!r}. Must be one of: {", ".join(REPORT_FORMATS)}.')
+    return fmt, path or None
+
+
+def open_destination(destination):
+    """
+    Opens the destination parsed by :func:`report_destination` right away, so a bad path is reported before waiting.
+
+    Returns:
+        file: Where to write the report.
+    """
+    _, path = destination
+    if path is None:
+        return sys.stdout
+    return Path(path).open("w")
+
+
+def histogram(latencies):
+    """
+    Returns:
+        dict: Cumulative counts of the latencies (like Prometheus histograms), by bucket upper bound.
+    """
+    counts = {}
+    for bound in BUCKETS:
+        counts[str(bound)] = sum(latency <= bound for latency in latencies)
+    counts["+Inf"] = len(latencies)
+    return counts
+
+
+class Report:
+    """
+    Records the attempts the engine made for each check and how long it slept between them.
+    """
+
+    def __init__(self):
+        self.start = time()
+        self.attempts = defaultdict(list)
+        self.sleeping = defaultdict(float)
+
+    def attempt(self, check, start, end):
+        self.attempts[check].append((start - self.start, end - start, type(check.error).__name__ if check.error else None))
+
+    def sleep(self, check, delay):
+        self.sleeping[check] += delay
+
+    def check_summary(self, check, *, verbose_passwords):
+        attempts = self.attempts[check]
+        passed = check.error is False
+        return {
+            "service": check.display(verbose=False, verbose_passwords=verbose_passwords),
+            "passed": passed,
+            "attempts": len(attempts),
+            "time_to_success": sum(attempts[-1][:2]) if passed else None,
+            "probing": sum(latency for _, latency, _ in attempts),
+            "sleeping": self.sleeping[check],
+            "history": [{"start": start, "latency": latency, "error": error} for start, latency, error in attempts],
+            "histogram": histogram([latency for _, latency, _ in attempts]),
+        }
+
+    def summary(self, checks, *, verbose_passwords):
+        checks = [self.check_summary(check, verbose_passwords=verbose_passwords) for check in checks]
+        return {
+            "version": __version__,
+            "elapsed": time() - self.start,
+            "passed": all(check["passed"] for check in checks),
+            "checks": checks,
+        }
+
+    def write(self, fh, checks, *, verbose_passwords):
+        """
+        Writes the report to the file opened by :func:`open_destination`.
+        """
+        json.dump(self.summary(checks, verbose_passwords=verbose_passwords), fh, indent=2)
+        fh.write("\n")
+        fh.flush()
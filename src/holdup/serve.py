@@ -0,0 +1,111 @@
+"""
+The ``holdup serve`` readiness endpoint. The engine keeps checking the services and updates the cached response after
+every attempt, requests are only answered from that cache.
+"""
+
+import socket
+import stat
+import threading
+from http.server import BaseHTTPRequestHandler
+from pathlib import Path
+from socketserver import ThreadingTCPServer
+from socketserver import ThreadingUnixStreamServer
+from time import time
+
+
+class Readiness:
+    """
+    Takes the place of the engine's :class:`holdup.report.Report`: instead of keeping all the attempts it only renders
+    the current status of the checks.
+    """
+
+    def __init__(self, checks, *, verbose_passwords):
+        self.start = time()
+        self.checks = checks
+        self.verbose_passwords = verbose_passwords
+        self.lock = threading.Lock()
+        self.response = None
+        self.refresh()
+
+    def attempt(self, check, start, end):
+        self.refresh()
+
+    def sleep(self, check, delay):
+        pass
+
+    def refresh(self):
+        ready = all(check.error is False for check in self.checks)
+        lines = [check.display(verbose=True, verbose_passwords=self.verbose_passwords) for check in self.checks]
+        body = "\n".join(lines).encode() + b"\n"
+        with self.lock:
+            self.response = 200 if ready else 503, body
+
+
+class ReadinessHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        path = self.path.split("?", 1)[0]
+        if path == "/ready":
+            with self.server.readiness.lock:
+                status, body = self.server.readiness.response
+        elif path == "/live":
+            status, body = 200, b"OK\n"
+        else:
+            self.send_error(404)
+            return
+        self.send_response(status)
+        self.send_header("Content-Type", "text/plain; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    do_HEAD = do_GET
+
+    def address_string(self):
+        return self.client_address[0] if self.client_address else "unix"
+
+    def log_message(self, *args):
+        pass
+
+
+class TcpReadinessServer(ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, family, address):
+        self.address_family = family
+        super().__init__(address, ReadinessHandler)
+
+
+class UnixReadinessServer(ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path):
+        try:
+            if stat.S_ISSOCK(Path(path).stat().st_mode):
+                Path(path).unlink()  # left behind by a previous run
+        except FileNotFoundError:
+            pass
+        super().__init__(path, ReadinessHandler)
+
+
+class ReadinessServer:
+    def __init__(self, listen, checks, *, verbose_passwords):
+        family, address = listen
+        if family == socket.AF_UNIX:
+            self.server = UnixReadinessServer(address)
+            self.url = f"unix://{address}"
+        else:
+            self.server = TcpReadinessServer(family, address)
+            host, port = self.server.server_address[:2]
+            self.url = f"http://[{host}]:{port}" if family == socket.AF_INET6 else f"http://{host}:{port}"
+        self.readiness = self.server.readiness = Readiness(checks, verbose_passwords=verbose_passwords)
+        self.thread = threading.Thread(target=self.server.serve_forever, name="holdup-serve", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+        if self.server.address_family == socket.AF_UNIX:
+            Path(self.server.server_address).unlink()
@@ -0,0 +1,229 @@
+"""
+Checks that make sure a service speaks its protocol, not only that it accepts connections (redis loading its dataset or
+rabbitmq booting do that long before they can serve). Each one is a single round trip over a plain socket (no client
+libraries): an optional request and just enough of the reply parsed to tell if the service is ready.
+"""
+
+import argparse
+import re
+import socket
+import struct
+from contextlib import closing
+from urllib.parse import parse_qsl
+from urllib.parse import unquote
+from urllib.parse import urlparse
+
+from . import net
+from .checks import Check
+
+# no protocol here needs more than this to tell, a longer reply means it's something else
+MAX_REPLY = 64 * 1024
+
+
+class WireCheck(Check):
+    """
+    Sends :attr:`request` (if any) and reads the reply until :meth:`verify` accepts it.
+    """
+
+    default_port = None
+    parameters = ()
+    request = b""
+
+    def __init__(self, url):
+        self.url = url
+        parsed_url = urlparse(url)
+        try:
+            self.port = parsed_url.port or self.default_port
+        except ValueError as exc:
+            raise argparse.ArgumentTypeError(f"Invalid service spec {url!r}. {exc}.") from None
+        self.host = parsed_url.hostname
+        if not self.host:
+            raise argparse.ArgumentTypeError(f"Invalid service spec {url!r}. Must have a host.")
+        if not self.port:
+            raise argparse.ArgumentTypeError(f"Invalid service spec {url!r}. Must have a port.")
+        self.user = None if parsed_url.username is None else unquote(parsed_url.username)
+        self.password = None if parsed_url.password is None else unquote(parsed_url.password)
+        self.query = {}
+        # latin-1 so that percent-encoded payloads come out as the exact bytes
+        for name, value in parse_qsl(parsed_url.query, keep_blank_values=True, encoding="latin-1"):
+            if name not in self.parameters:
+                raise argparse.ArgumentTypeError(f"Invalid service spec {url!r}. Unknown parameter: {name}.")
+            self.query[name] = value
+
+    def verify(self, reply):
+        """
+        Returns:
+            bool: ``True`` if the reply is complete and good, ``False`` if more is needed.
+
+        Raises:
+            Exception: If the reply shows the service isn't ready (or isn't what it should be).
+        """
+        raise NotImplementedError
+
+    def feed(self, reply, data):
+        if not data:
+            raise ConnectionResetError("Connection closed before a complete reply")
+        reply += data
+        if len(reply) > MAX_REPLY:
+            raise Exception(f"No valid reply in the first {MAX_REPLY} bytes")
+        return reply, self.verify(reply)
+
+    def run(self, options):
+        addresses = options.resolver.getaddrinfo(self.host, self.port, 0, socket.SOCK_STREAM)
+        with closing(net.connect(addresses, options.check_timeout)) as sock:
+            if self.request:
+                sock.sendall(self.request)
+            reply, done = b"", False
+            while not done:
+                reply, done = self.feed(reply, sock.recv(65536))
+
+    async def arun(self, options):
+        import asyncio
+
+        await asyncio.wait_for(self.aprobe(options), options.check_timeout)
+
+    async def aprobe(self, options):
+        import asyncio
+
+        loop = asyncio.get_running_loop()
+        addresses = await options.resolver.agetaddrinfo(self.host, self.port, 0, socket.SOCK_STREAM)
+        with closing(await net.aconnect(addresses)) as sock:
+            if self.request:
+                await loop.sock_sendall(sock, self.request)
+            reply, done = b"", False
+            while not done:
+                reply, done = self.feed(reply, await loop.sock_recv(sock, 65536))
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}({self.display_definition(verbose_passwords=False)}, status={self.status})"
+
+    def display_definition(self, *, verbose_passwords, _password_re=re.compile(r":[^@:/]*@")):
+        definition = self.url
+        if not verbose_passwords:
+            definition = _password_re.sub(":******@", definition, 1)
+        return definition
+
+
+def resp_command(*args):
+    return b"*%d\r\n" % len(args) + b"".join(b"$%d\r\n%s\r\n" % (len(arg), arg) for arg in args)
+
+
+class RedisCheck(WireCheck):
+    """
+    ``PING`` (after ``AUTH`` if there's a password), only ``+PONG`` passes: a redis still loading its dataset replies
+    with a ``-LOADING`` error.
+    """
+
+    default_port = 6379
+
+    def __init__(self, url):
+        super().__init__(url)
+        self.request = b""
+        self.replies = 1
+        if self.password is not None:
+            credentials = [self.user.encode()] if self.user else []
+            self.request = resp_command(b"AUTH", *credentials, self.password.encode())
+            self.replies = 2
+        self.request += resp_command(b"PING")
+
+    def verify(self, reply):
+        lines = reply.split(b"\r\n")[:-1]
+        for line in lines:
+            if line.startswith(b"-"):
+                raise Exception(f"Redis replied: {line[1:].decode(errors='replace')}")
+        if len(lines) < self.replies:
+            return False
+        if lines[-1] != b"+PONG":
+            raise Exception(f"Unexpected reply to PING: {lines[-1]!r}")
+        return True
+
+
+class MemcachedCheck(WireCheck):
+    """
+    ``version``, a ``VERSION`` reply passes.
+    """
+
+    default_port = 11211
+    request = b"version\r\n"
+
+    def verify(self, reply):
+        if b"\r\n" not in reply:
+            return False
+        line = reply.split(b"\r\n", 1)[0]
+        if not line.startswith(b"VERSION "):
+            raise Exception(f"Unexpected reply to version: {line.decode(errors='replace')}")
+        return True
+
+
+class AmqpCheck(WireCheck):
+    """
+    The AMQP 0-9-1 protocol header, the ``Connection.Start`` method the broker replies with passes.
+    """
+
+    default_port = 5672
+    request = b"AMQP\x00\x00\x09\x01"
+
+    def verify(self, reply):
+        if reply.startswith(b"AMQP"):
+            if len(reply) < 8:
+                return False
+            raise Exception(f"The server wants another AMQP version: {'.'.join(map(str, reply[5:8]))}")
+        if len(reply) < 11:
+            return False
+        frame_type, channel, _, class_id, method_id = struct.unpack_from("!BHIHH", reply)
+        if (frame_type, channel, class_id, method_id) != (1, 0, 10, 10):
+            raise Exception(f"Unexpected reply to the protocol header: {reply[:11]!r}")
+        return True
+
+
+class MysqlCheck(WireCheck):
+    """
+    Nothing is sent, the server's greeting (the initial handshake packet) passes and an error packet (eg: too many
+    connections, host blocked) fails with its message.
+    """
+
+    default_port = 3306
+
+    def verify(self, reply):
+        if len(reply) < 4:
+            return False
+        length = int.from_bytes(reply[:3], "little")
+        if len(reply) < 4 + length:
+            return False
+        payload = reply[4 : 4 + length]
+        if payload[:1] == b"\xff":
+            (code,) = struct.unpack_from("<H", payload, 1)
+            message = payload[3:]
+            if message.startswith(b"#"):
+                message = message[6:]  # the SQL state
+            raise Exception(f"MySQL error {code}: {message.decode(errors='replace')}")
+        if payload[:1] not in (b"\x09", b"\x0a"):
+            raise Exception(f"Unexpected greeting: {reply[:16]!r}")
+        return True
+
+
+class TcpExpectCheck(WireCheck):
+    """
+    Sends the (percent-encoded) ``send`` parameter, if any, and passes once the reply contains the ``expect`` parameter.
+    """
+
+    parameters = ("send", "expect")
+
+    def __init__(self, url):
+        super().__init__(url)
+        if not self.query.get("expect"):
+            raise argparse.ArgumentTypeError(f"Invalid service spec {url!r}. Must have an expect parameter.")
+        self.request = self.query.get("send", "").encode("latin-1")
+        self.expect = self.query["expect"].encode("latin-1")
+
+    def verify(self, reply):
+        return self.expect in reply
+
+
+CHECKS = {
+    "redis": RedisCheck,
+    "memcached": MemcachedCheck,
+    "amqp": AmqpCheck,
+    "mysql": MysqlCheck,
+    "tcp+expect": TcpExpectCheck,
+}
@@ -1,9 +1,355 @@
+import base64
+import hashlib
+import hmac
+import os
+import shutil
+import socket
+import socketserver
+import ssl
+import struct
+import subprocess
+import threading
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+
 import pytest
 
 
-def pytest_collection_modifyitems(items):
+def pytest_addoption(parser):
+    parser.addoption("--large", action="store_true", help="Also run the large benchmarks (1000 services).")
+
+
+def pytest_collection_modifyitems(config, items):
     for item in items:
         if item.name.startswith("test_func"):
             item.add_marker(pytest.mark.func)
         else:
             item.add_marker(pytest.mark.unit)
+        if item.get_closest_marker("large") and not config.getoption("large"):
+            item.add_marker(pytest.mark.skip(reason="large benchmark, run with --large"))
+
+
+@contextmanager
+def serving(server):
+    """
+    Serves in a thread until the end of the block, then closes the server.
+    """
+    server.daemon_threads = True
+    t = threading.Thread(target=server.serve_forever, kwargs={"poll_interval": 0.01})
+    t.start()
+    try:
+        yield server
+    finally:
+        server.shutdown()
+        server.server_close()
+        t.join()
+
+
+@pytest.fixture(scope="session")
+def tls_certificate(tmp_path_factory):
+    if not shutil.which("openssl"):
+        pytest.skip("openssl is not available")
+    path = tmp_path_factory.mktemp("tls")
+    cert, key = path / "cert.pem", path / "key.pem"
+    subprocess.run(
+        ["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-subj", "/CN=localhost", "-days", "1", "-keyout", key, "-out", cert],
+        check=True,
+        capture_output=True,
+    )
+    return cert, key
+
+
+class HttpStubHandler(BaseHTTPRequestHandler):
+    """
+    Replies with the status code in the path (200 for ``/``), except for ``/redirect/PATH`` (redirects to ``PATH``),
+    ``/health`` (a big diagnostics page) and ``/head-only`` (405 unless it's a ``HEAD`` request). Keeps the connections
+    alive, the server's ``clients`` has the client address of each request. Over TLS, the server's ``reused`` keeps
+    whether each request's connection resumed a TLS session.
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.server.clients.append(self.client_address)
+        if hasattr(self.connection, "session_reused"):
+            self.server.reused.append(self.connection.session_reused)
+        body = b""
+        if self.path.startswith("/redirect/"):
+            self.send_response(302)
+            self.send_header("Location", self.path[len("/redirect") :])
+        elif self.path == "/health":
+            self.send_response(200)
+            body = b'{"status": "ok", "diagnostics": "' + b"x" * 1024 * 1024 + b'"}'
+        elif self.path == "/head-only":
+            self.send_response(200 if self.command == "HEAD" else 405)
+        else:
+            self.send_response(int(self.path.strip("/") or 200))
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    do_HEAD = do_GET
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def http_server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), HttpStubHandler)
+    server.clients = []
+    with serving(server):
+        yield server
+
+
+@pytest.fixture
+def https_server(tls_certificate):
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(*tls_certificate)
+    server = ThreadingHTTPServer(("127.0.0.1", 0), HttpStubHandler)
+    server.socket = context.wrap_socket(server.socket, server_side=True)
+    server.clients = []
+    server.reused = []
+    with serving(server):
+        yield server
+
+
+class PgStubHandler(socketserver.BaseRequestHandler):
+    """
+    Just enough of the PostgreSQL wire protocol (v3) to let a client connect and run a query (simple or extended
+    protocol), every query returns a single ``version`` row.
+
+    The server's attributes pick the behavior: ``ssl_context`` (SSL is refused if ``None``), ``auth`` (``None`` for
+    trust, ``"password"``, ``"md5"`` or ``"scram"``) with ``password`` and ``reject`` (a SQLSTATE to refuse the
+    connection with). Incrementing ``generation`` simulates a restart: older connections get terminated at their next
+    query. ``connections`` counts the connections.
+    """
+
+    def handle(self):
+        self.server.connections += 1
+        self.generation = self.server.generation
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.rfile = self.request.makefile("rb")
+        while True:
+            header = self.rfile.read(8)
+            if len(header) < 8:  # the client didn't like the answer to SSLRequest
+                return
+            length, code = struct.unpack("!II", header)
+            payload = self.rfile.read(length - 8)
+            if code == 80877103 and self.server.ssl_context:  # SSLRequest
+                self.request.sendall(b"S")
+                self.request = self.server.ssl_context.wrap_socket(self.request, server_side=True, do_handshake_on_connect=False)
+                try:
+                    self.request.do_handshake()
+                except ssl.SSLError:  # the client didn't like the certificate
+                    return
+                self.rfile = self.request.makefile("rb")
+            elif code in (80877103, 80877104):  # SSLRequest, GSSENCRequest
+                self.request.sendall(b"N")
+            else:
+                break
+        parameters = payload.split(b"\0")
+        self.user = dict(zip(parameters[::2], parameters[1::2]))[b"user"]
+        if self.server.reject:
+            self.error(self.server.reject, "the database system is starting up")
+            return
+        try:
+            if not self.authenticate():
+                self.error("28P01", "password authentication failed")
+                return
+        except EOFError:  # the client only wanted to know if the server is up
+            return
+        self.send(b"R", struct.pack("!I", 0))
+        for name, value in [
+            ("server_version", "16.0"),
+            ("client_encoding", "UTF8"),
+            ("standard_conforming_strings", "on"),
+            ("DateStyle", "ISO, MDY"),
+        ]:
+            self.send(b"S", f"{name}\0{value}\0".encode())
+        self.send(b"K", struct.pack("!II", 1, 1))
+        self.send(b"Z", b"I")
+        while True:
+            kind = self.rfile.read(1)
+            if not kind or kind == b"X":
+                return
+            (length,) = struct.unpack("!I", self.rfile.read(4))
+            payload = self.rfile.read(length - 4)
+            if self.generation != self.server.generation:
+                self.error("57P01", "terminating connection due to administrator command")
+                return
+            if kind == b"Q":
+                self.row_description()
+                self.data_row()
+                self.send(b"Z", b"I")
+            elif kind == b"P":
+                self.send(b"1")
+            elif kind == b"B":
+                self.send(b"2")
+            elif kind == b"D":
+                if payload[:1] == b"S":
+                    self.send(b"t", struct.pack("!H", 0))
+                self.row_description()
+            elif kind == b"E":
+                self.data_row()
+            elif kind == b"C":
+                self.send(b"3")
+            elif kind == b"S":
+                self.send(b"Z", b"I")
+
+    def finish(self):
+        self.request.close()  # might be a wrapped socket, unknown to the server
+
+    def send(self, kind, payload=b""):
+        self.request.sendall(kind + struct.pack("!I", len(payload) + 4) + payload)
+
+    def receive(self):
+        kind = self.rfile.read(1)
+        if not kind:
+            raise EOFError
+        (length,) = struct.unpack("!I", self.rfile.read(4))
+        return kind, self.rfile.read(length - 4)
+
+    def error(self, code, message):
+        self.send(b"E", f"SFATAL\0C{code}\0M{message}\0\0".encode())
+
+    def authenticate(self):
+        auth = self.server.auth
+        password = self.server.password.encode()
+        if auth == "password":
+            self.send(b"R", struct.pack("!I", 3))
+            return self.receive()[1] == password + b"\0"
+        elif auth == "md5":
+            salt = os.urandom(4)
+            self.send(b"R", struct.pack("!I", 5) + salt)
+            inner = hashlib.md5(password + self.user).hexdigest().encode()  # noqa: S324
+            return self.receive()[1] == b"md5" + hashlib.md5(inner + salt).hexdigest().encode() + b"\0"  # noqa: S324
+        elif auth == "scram":
+            self.send(b"R", struct.pack("!I", 10) + b"SCRAM-SHA-256\0\0")
+            _, payload = self.receive()
+            _, _, rest = payload.partition(b"\0")
+            client_first_bare = rest[4:].decode().split(",", 2)[2]
+            nonce = dict(item.split("=", 1) for item in client_first_bare.split(","))["r"] + "server"
+            salt = os.urandom(16)
+            server_first = f"r={nonce},s={base64.b64encode(salt).decode()},i=4096"
+            self.send(b"R", struct.pack("!I", 11) + server_first.encode())
+            _, payload = self.receive()
+            client_final_without_proof, _, proof = payload.decode().rpartition(",p=")
+            auth_message = f"{client_first_bare},{server_first},{client_final_without_proof}".encode()
+            salted_password = hashlib.pbkdf2_hmac("sha256", password, salt, 4096)
+            client_key = hmac.digest(salted_password, b"Client Key", "sha256")
+            client_signature = hmac.digest(hashlib.sha256(client_key).digest(), auth_message, "sha256")
+            if base64.b64decode(proof) != bytes(a ^ b for a, b in zip(client_key, client_signature)):
+                return False
+            server_key = hmac.digest(salted_password, b"Server Key", "sha256")
+            self.send(b"R", struct.pack("!I", 12) + b"v=" + base64.b64encode(hmac.digest(server_key, auth_message, "sha256")))
+        return True
+
+    def row_description(self):
+        self.send(b"T", struct.pack("!H", 1) + b"version\0" + struct.pack("!IHIhiH", 0, 0, 25, -1, -1, 0))
+
+    def data_row(self):
+        self.send(b"D", struct.pack("!HI", 1, 11) + b"PostgreSQL ")
+        self.send(b"C", b"SELECT 1\0")
+
+
+@pytest.fixture
+def pg_stub():
+    server = socketserver.ThreadingTCPServer(("127.0.0.1", 0), PgStubHandler)
+    server.ssl_context = server.auth = server.reject = None
+    server.password = ""
+    server.connections = server.generation = 0
+    with serving(server):
+        yield server
+
+
+class WireStubHandler(socketserver.BaseRequestHandler):
+    """
+    A canned conversation: sends the server's ``greeting`` (if any) right away, then answers the first thing it receives
+    (kept in ``received``) with ``reply`` (if any).
+    """
+
+    def handle(self):
+        if self.server.greeting:
+            self.request.sendall(self.server.greeting)
+        if self.server.reply:
+            self.server.received.append(self.request.recv(65536))
+            self.request.sendall(self.server.reply)
+        self.request.recv(1)  # until the client hangs up
+
+
+@pytest.fixture
+def wire_stub():
+    server = socketserver.ThreadingTCPServer(("127.0.0.1", 0), WireStubHandler)
+    server.greeting = server.reply = None
+    server.received = []
+    with serving(server):
+        yield server
+
+
+class GrpcStubHandler(socketserver.BaseRequestHandler):
+    """
+    Just enough HTTP/2 to answer a gRPC health check. The server's ``statuses`` maps service names to their serving
+    status, the others get a ``NOT_FOUND`` error (a trailers-only response, split in a ``CONTINUATION`` frame).
+    ``ssl_context`` enables TLS. The checked service names are kept in ``services``.
+
+    The header blocks were encoded like real servers do it: with Huffman coding and indexing.
+    """
+
+    RESPONSE_HEADERS = bytes.fromhex("885f8b1d75d0620d263d4c4d6564")  # :status 200, content-type application/grpc
+    TRAILERS = bytes.fromhex("40889acac8b21234da8f810740899acac8b5254207317f80")  # grpc-status 0, grpc-message ""
+    NOT_FOUND = bytes.fromhex(  # the response headers, grpc-status 5, grpc-message "unknown service"
+        "885f8b1d75d0620d263d4c4d656440889acac8b21234da8f816f40899acac8b5254207317f8bb6aeb51fc54a20b677310b"
+    )
+
+    def handle(self):
+        if self.server.ssl_context:
+            self.request = self.server.ssl_context.wrap_socket(self.request, server_side=True, do_handshake_on_connect=False)
+            try:
+                self.request.do_handshake()
+            except ssl.SSLError:
+                return
+        with self.request.makefile("rb") as rfile:
+            if rfile.read(24) != b"PRI * HTTP/2.0\r\n\r\nSM\r\n\r\n":
+                return
+            self.send(0x4, 0, 0)  # SETTINGS
+            self.send(0x6, 0, 0, b"pingpong")  # PING
+            body = b""
+            while True:
+                header = rfile.read(9)
+                if len(header) < 9:
+                    return
+                kind, flags, stream_id = struct.unpack_from("!BBI", header, 3)
+                payload = rfile.read(int.from_bytes(header[:3], "big"))
+                if kind == 0x0 and stream_id == 1:  # DATA
+                    body += payload
+                    if flags & 0x1:  # END_STREAM
+                        break
+            service = body[7:].decode()  # after the gRPC framing, the field's key and length
+            self.server.services.append(service)
+            if service in self.server.statuses:
+                self.send(0x1, 0x4, 1, self.RESPONSE_HEADERS)  # HEADERS, END_HEADERS
+                self.send(0x0, 0, 1, struct.pack("!BIBB", 0, 2, 0x08, self.server.statuses[service]))  # DATA
+                self.send(0x1, 0x5, 1, self.TRAILERS)  # HEADERS, END_HEADERS | END_STREAM
+            else:
+                self.send(0x1, 0x1, 1, self.NOT_FOUND[:20])  # HEADERS, END_STREAM
+                self.send(0x9, 0x4, 1, self.NOT_FOUND[20:])  # CONTINUATION, END_HEADERS
+            rfile.read()  # until the client hangs up
+
+    def finish(self):
+        self.request.close()  # might be a wrapped socket, unknown to the server
+
+    def send(self, kind, flags, stream_id, payload=b""):
+        self.request.sendall(len(payload).to_bytes(3, "big") + struct.pack("!BBI", kind, flags, stream_id) + payload)
+
+
+@pytest.fixture
+def grpc_stub():
+    server = socketserver.ThreadingTCPServer(("127.0.0.1", 0), GrpcStubHandler)
+    server.ssl_context = None
+    server.statuses = {"": 1}
+    server.services = []
+    with serving(server):
+        yield server